@@ -1,20 +1,45 @@
+import logging
+import os
+import pickle
+import tempfile
+import time
 import uuid
 from abc import ABC
-from typing import List, Literal, Optional, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from typing import Any, Dict, Iterable, List, Literal, NamedTuple, Optional, Sequence, Set, Tuple
 
 import nslsii.kafka_utils
 import numpy as np
 import tiled
 from bluesky_adaptive.agents.base import Agent, AgentConsumer
+from bluesky_adaptive.server import register_variable
 from bluesky_kafka import Publisher
 from bluesky_queueserver_api.http import REManagerAPI
 from numpy.typing import ArrayLike
 
-from .utils import Pandrosus
+from .cache import SpectrumCache
+from .utils import Pandrosus, exp_energy_grid, exp_k_grid, resample
+
+logger = logging.getLogger(__name__)
+
+
+class RawRun(NamedTuple):
+    """Measured data of a run as read from tiled, before any processing.
+    Quacks enough like a run for ``Pandrosus.fetch`` when given the table."""
+
+    start: dict
+    table: Dict[str, np.ndarray]
+    positions: Dict[str, float]
 
 
 class BMMBaseAgent(Agent, ABC):
     sample_position_motors = ("xafs_x", "xafs_y")
+    _checkpoint_version = 2
+    # Reports are made when all of: min_interval seconds have passed since the last, every_n_tells runs have
+    # been told since the last, and (if not None) the model has changed by more than center_tolerance.
+    # The default holds nothing back.
+    default_report_policy = dict(min_interval=0.0, every_n_tells=0, center_tolerance=None)
 
     def __init__(
         self,
@@ -34,6 +59,16 @@ class BMMBaseAgent(Agent, ABC):
         exp_steps: str = "10 2 0.3 0.05k",
         exp_times: str = "0.5 0.5 0.5 0.5",
         variable_motor_names: List[str] = ["xafs_x"],
+        spectrum_cache_dir: Optional[str] = None,
+        spectrum_cache_bytes: int = 2**30,
+        read_chunk_size: Optional[int] = None,
+        fast_norm: bool = False,
+        resample_to_exp_grid: bool = True,
+        ordinate_grid: Optional[ArrayLike] = None,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_every: int = 10,
+        max_tell_batch: int = 32,
+        report_policy: Optional[Dict[str, Any]] = None,
         **kwargs,
     ):
         self._filename = filename
@@ -41,7 +76,6 @@ class BMMBaseAgent(Agent, ABC):
         self._exp_mode = exp_mode
         self._read_mode = read_mode
         self._abscissa = exp_data_type
-        self._ordinate = "k" if exp_data_type == "chi" else "norm"
         self._elements = elements
         self._element_origins = np.array(element_origins)
         self._element_det_positions = np.array(element_det_positions)
@@ -53,6 +87,29 @@ class BMMBaseAgent(Agent, ABC):
         self._exp_steps = exp_steps
         self._exp_times = exp_times
         self._variable_motor_names = variable_motor_names
+        self.read_chunk_size = read_chunk_size
+        self.fast_norm = fast_norm
+        self.resample_to_exp_grid = resample_to_exp_grid
+        self._ordinate_grid = None if ordinate_grid is None else np.array(ordinate_grid, dtype=float)
+        self._roi_slices = {}  # (ordinate, index slice) keyed by ordinate id and roi
+        self._full_range_spectra = {}  # (ordinate, observable) before the roi is applied, keyed by uid
+        self._raw_runs = {}  # RawRun keyed by uid
+        self.spectrum_cache = (
+            SpectrumCache(spectrum_cache_dir, max_bytes=spectrum_cache_bytes) if spectrum_cache_dir else None
+        )
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self._tells_since_checkpoint = 0
+        self._restarting = False
+        self._bootstrap_status = dict(state="idle")
+        self.max_tell_batch = max_tell_batch
+        self._pending_tells = []  # Uids of finished runs waiting to be told as a batch
+        self._failed_tells = 0  # Queued runs dropped after failing to unpack
+        self._report_policy = dict(self.default_report_policy)
+        self.report_policy = report_policy or {}
+        self._pending_report = None  # Keyword arguments of a report held back by the report policy
+        self._last_report_time = None
+        self._tells_at_last_report = 0
 
         _default_kwargs = self.get_beamline_objects()
         _default_kwargs.update(kwargs)
@@ -81,7 +138,8 @@ class BMMBaseAgent(Agent, ABC):
     @exp_mode.setter
     def exp_mode(self, value: Literal["fluorescence", "transmission"]):
         self._exp_mode = value
-        self.close_and_restart(clear_tell_cache=True)
+        # Only changes how new data are measured, so what has been told still stands
+        self.close_and_restart(reason="exp_mode change")
 
     @property
     def read_mode(self):
@@ -90,7 +148,7 @@ class BMMBaseAgent(Agent, ABC):
     @read_mode.setter
     def read_mode(self, value: Literal["fluorescence", "transmission"]):
         self._read_mode = value
-        self.close_and_restart(clear_tell_cache=True)
+        self.rederive_or_clear(reason="read_mode change")
 
     @property
     def exp_data_type(self):
@@ -99,8 +157,7 @@ class BMMBaseAgent(Agent, ABC):
     @exp_data_type.setter
     def exp_data_type(self, value: Literal["chi", "mu"]):
         self._abscissa = value
-        self._ordinate = "k" if value == "chi" else "norm"
-        self.close_and_restart(clear_tell_cache=True)
+        self.rederive_or_clear(reason="exp_data_type change")
 
     @property
     def elements(self):
@@ -133,7 +190,11 @@ class BMMBaseAgent(Agent, ABC):
     @roi.setter
     def roi(self, value: Tuple[float, float]):
         self._roi = value
-        self.close_and_restart(clear_tell_cache=True)
+        observables = self.roi_observables()
+        if observables is not None and self.replace_observables(observables):
+            self.close_and_restart(reason="ROI change")
+        else:
+            self.rederive_or_clear(reason="ROI change")
 
     @property
     def sample(self):
@@ -158,6 +219,8 @@ class BMMBaseAgent(Agent, ABC):
     @exp_bounds.setter
     def exp_bounds(self, value: str):
         self._exp_bounds = value
+        if self.resample_to_exp_grid and self._ordinate_grid is None:
+            self.rederive_or_clear(reason="exp_bounds change")
 
     @property
     def exp_steps(self):
@@ -166,6 +229,8 @@ class BMMBaseAgent(Agent, ABC):
     @exp_steps.setter
     def exp_steps(self, value: str):
         self._exp_steps = value
+        if self.resample_to_exp_grid and self._ordinate_grid is None:
+            self.rederive_or_clear(reason="exp_steps change")
 
     @property
     def exp_times(self):
@@ -175,6 +240,25 @@ class BMMBaseAgent(Agent, ABC):
     def exp_times(self, value: str):
         self._exp_times = value
 
+    @property
+    def report_policy(self) -> Dict[str, Any]:
+        return dict(self._report_policy)
+
+    @report_policy.setter
+    def report_policy(self, value: Dict[str, Any]):
+        unknown = set(value) - set(self.default_report_policy)
+        if unknown:
+            raise ValueError(f"Unknown report policy keys {unknown}, expected {set(self.default_report_policy)}")
+        self._report_policy.update(value)
+
+    @property
+    def ordinate_grid(self) -> np.ndarray:
+        """Grid every spectrum is resampled onto, in eV relative to e0 for mu, or in k for chi.
+        Derived from exp_bounds and exp_steps unless given to the constructor."""
+        if self._ordinate_grid is not None:
+            return self._ordinate_grid
+        return _exp_grid(self.exp_data_type, self.exp_bounds, self.exp_steps)
+
     def server_registrations(self) -> None:
         # This ensures relevant properties are in the rest API
         self._register_property("filename")
@@ -189,19 +273,646 @@ class BMMBaseAgent(Agent, ABC):
         self._register_property("exp_bounds")
         self._register_property("exp_steps")
         self._register_property("exp_times")
+        self._register_property("report_policy")
+        self._register_method("save_checkpoint")
+        self._register_method("bootstrap")
+        register_variable("bootstrap_status", getter=lambda: self.bootstrap_status)
         return super().server_registrations()
 
+    def raw_run(self, run, columns: Sequence[str]) -> RawRun:
+        """Raw data held for a run, reading from tiled only the columns and baseline positions not yet held.
+
+        Parameters
+        ----------
+        run : databroker.client.BlueskyRun or RawRun
+            Run to read from. A RawRun can stand in when everything needed is already held.
+        columns : Sequence[str]
+            Primary stream columns that are needed
+        """
+        uid = run.start["uid"]
+        raw = self._raw_runs.get(uid)
+        if raw is None:
+            raw = self._raw_runs[uid] = RawRun(dict(run.start), {}, {})
+        missing = [column for column in columns if column not in raw.table]
+        if missing:
+            table = Pandrosus.read_columns(run, missing, chunk_size=self.read_chunk_size)
+            raw.table.update({column: np.asarray(table[column]) for column in missing})
+        for name in self._variable_motor_names:
+            if name not in raw.positions:
+                raw.positions[name] = run.baseline.data[name][0]
+        return raw
+
+    def run_start(self, uid: str) -> dict:
+        """Start document of a run, from held raw data where possible"""
+        return self._raw_runs[uid].start if uid in self._raw_runs else self.exp_catalog[uid].start
+
+    def holds_raw(self, uid: str) -> bool:
+        """Whether everything needed to process a run in the current read mode is held"""
+        raw = self._raw_runs.get(uid)
+        return (
+            raw is not None
+            and all(column in raw.table for column in Pandrosus.xmu_columns(raw.start, self.read_mode))
+            and all(name in raw.positions for name in self._variable_motor_names)
+        )
+
+    def rederive(self, uids: Optional[Sequence[str]] = None) -> bool:
+        """Rebuild the observations of told runs after a processing parameter has changed, without a retell.
+        Held raw data are reprocessed, and only runs (or columns) not held are read from tiled.
+
+        Parameters
+        ----------
+        uids : Optional[Sequence[str]]
+            Runs to rebuild from, by default every run in the tell cache
+
+        Returns
+        -------
+        bool
+            False if this agent cannot replace its observations in place.
+            The full range spectra are then left as they were, as they are if anything raises.
+        """
+        uids = list(self.tell_cache if uids is None else uids)
+        previous_spectra, self._full_range_spectra = self._full_range_spectra, {}
+        try:
+            told, independents, observables = [], [], []
+            for uid in uids:
+                try:
+                    run = self._raw_runs[uid] if self.holds_raw(uid) else self.exp_catalog[uid]
+                    x, y = self.unpack_run(run)
+                except Exception as e:
+                    logger.warning(f"Dropping {uid} from rederived data after failing to unpack it:\n {e!r}")
+                    self._full_range_spectra.pop(uid, None)
+                    continue
+                told.append(uid)
+                independents.append(x)
+                observables.append(y)
+            replaced = self.replace_observations(told, independents, observables)
+        except BaseException:
+            self._full_range_spectra = previous_spectra
+            raise
+        if not replaced:
+            self._full_range_spectra = previous_spectra
+        return replaced
+
+    def replace_observations(
+        self, uids: List[str], independents: List[np.ndarray], observables: List[np.ndarray]
+    ) -> bool:
+        """Swap in a complete new set of told runs and their observations.
+        Agents that keep caches of observations override this. Returns False if it could not be done."""
+        return False
+
+    def rederive_or_clear(self, uids: Optional[Sequence[str]] = None, reason: str = ""):
+        """Rebuild observations and restart the document stream, or clear them if they cannot be rebuilt"""
+        try:
+            rederived = self.rederive(uids)
+        except Exception as e:
+            logger.warning(f"Clearing the tell cache after failing to rederive observations:\n {e!r}")
+            rederived = False
+        if rederived:
+            self.close_and_restart(reason=reason)
+        else:
+            self.close_and_restart(clear_tell_cache=True, reason=reason)
+
+    def spectrum_needs(self) -> Set[str]:
+        """Processed fields needed to build observations for the agent's ``exp_data_type`` and ``roi``.
+        The ordinate of every observation is needed, even without resampling or an roi, so that the full
+        range spectra kept for later roi changes are all relative to the edge."""
+        return {"energy", self.exp_data_type, "k" if self.exp_data_type == "chi" else "e0"}
+
+    def cached_spectrum(self, uid: str) -> Optional[Tuple[dict, dict]]:
+        """Processed arrays and baseline positions for a run from the spectrum cache,
+        or None if there is no cache or it does not hold everything needed"""
+        if self.spectrum_cache is None:
+            return None
+        entry = self.spectrum_cache.get(self._spectrum_cache_key(uid))
+        if (
+            entry is not None
+            and self.spectrum_needs() <= entry[0].keys()
+            and all(name in entry[1] for name in self._variable_motor_names)
+        ):
+            return entry
+        return None
+
+    def _spectrum_cache_key(self, uid: str) -> str:
+        defaults = Pandrosus(fast_norm=self.fast_norm)
+        return SpectrumCache.key(
+            uid, self.read_mode, defaults.pre, defaults.bkg, defaults.fft, fast_norm=self.fast_norm
+        )
+
+    def _keep_spectrum(self, preprocessor: Pandrosus, raw: RawRun) -> Tuple[dict, dict]:
+        """Collect the processed arrays of a prepared run, adding them to the spectrum cache"""
+        group = preprocessor.group
+        # Keep whatever the stages that ran have produced, not only what is needed now
+        arrays = {name: getattr(group, name) for name in SpectrumCache.fields if name in vars(group)}
+        positions = {name: raw.positions[name] for name in self._variable_motor_names}
+        if self.spectrum_cache is not None:
+            self.spectrum_cache.put(self._spectrum_cache_key(raw.start["uid"]), arrays, positions)
+        return arrays, positions
+
+    def processed_spectrum(self, run) -> Tuple[dict, dict]:
+        """Processed arrays and baseline motor positions for a run.
+        Served from the spectrum cache when one is configured, otherwise fetched and processed with Larch.
+        Only the processing stages needed for the agent's ``exp_data_type`` and ``roi`` are run.
+
+        Returns
+        -------
+        arrays : dict
+            Processed arrays, keyed by the names in SpectrumCache.fields
+        positions : dict
+            Baseline positions, keyed by motor name
+        """
+        entry = self.cached_spectrum(run.start["uid"])
+        if entry is not None:
+            return entry
+        return self._process_raw(self.raw_run(run, Pandrosus.xmu_columns(run.start, self.read_mode)))
+
+    def _process_raw(self, raw: RawRun) -> Tuple[dict, dict]:
+        run_preprocessor = Pandrosus(fast_norm=self.fast_norm)
+        run_preprocessor.fetch(raw, mode=self.read_mode, table=raw.table)
+        for name in self.spectrum_needs():
+            getattr(run_preprocessor.group, name)
+        return self._keep_spectrum(run_preprocessor, raw)
+
+    def roi_slice(self, ordinate: np.ndarray) -> slice:
+        """Slice of a sorted ordinate that falls within the roi, inclusive of both ends.
+        Slices are cached by grid object, so spectra sharing ``ordinate_grid`` only search it once.
+        The grid is held with its slice, so that its id cannot be reused by another array while cached."""
+        if self.roi is None:
+            return slice(None)
+        key = (id(ordinate), tuple(self.roi))
+        cached = self._roi_slices.get(key)
+        if cached is None or cached[0] is not ordinate:
+            if len(self._roi_slices) >= 128:
+                self._roi_slices.clear()
+            lower = np.searchsorted(ordinate, self.roi[0], side="left")
+            upper = np.searchsorted(ordinate, self.roi[1], side="right")
+            cached = self._roi_slices[key] = (ordinate, slice(int(lower), int(upper)))
+        return cached[1]
+
+    def roi_observables(self) -> Optional[List[np.ndarray]]:
+        """Observables of every told run, re-sliced to the current roi.
+        None if any told run is not held at full range."""
+        try:
+            spectra = [self._full_range_spectra[uid] for uid in self.tell_cache]
+        except KeyError:
+            return None
+        return [y[self.roi_slice(ordinate)] for ordinate, y in spectra]
+
+    def replace_observables(self, observables: List[np.ndarray]) -> bool:
+        """Swap in new observables for every told run, in tell order, without a retell.
+        Agents that keep an observable cache override this. Returns False if it could not be done."""
+        return False
+
+    def close_and_restart(self, *, clear_tell_cache=False, retell_all=False, reason=""):
+        if clear_tell_cache or retell_all:
+            self._full_range_spectra = {}
+            self._tell_cache_replaced()
+        if clear_tell_cache:
+            self._raw_runs = {}
+        # Checkpoint once the restart is through, rather than on the intermediate stop
+        self._restarting = True
+        try:
+            ret = super().close_and_restart(
+                clear_tell_cache=clear_tell_cache, retell_all=retell_all, reason=reason
+            )
+        finally:
+            self._restarting = False
+        self._checkpoint_if_due(force=True)
+        return ret
+
+    def checkpoint_signature(self) -> Dict[str, Any]:
+        """Parameters the told observations were derived with.
+        A checkpoint is only restored into an agent whose signature matches."""
+        return dict(
+            name=self.name,
+            read_mode=self.read_mode,
+            exp_data_type=self.exp_data_type,
+            roi=None if self.roi is None else tuple(self.roi),
+            resample_to_exp_grid=self.resample_to_exp_grid,
+            ordinate_grid=self.ordinate_grid.tolist() if self.resample_to_exp_grid else None,
+            fast_norm=self.fast_norm,
+            variable_motor_names=list(self._variable_motor_names),
+        )
+
+    def checkpoint_state(self) -> Dict[str, Any]:
+        """State needed to resume without a retell. Agents that keep caches extend this."""
+        return dict(
+            tell_cache=list(self.tell_cache),
+            pending_tells=list(self._pending_tells),
+            full_range_spectra={
+                uid: (np.asarray(ordinate), np.asarray(y))
+                for uid, (ordinate, y) in self._full_range_spectra.items()
+            },
+        )
+
+    def restore_checkpoint_state(self, state: Dict[str, Any]):
+        """Inverse of ``checkpoint_state``"""
+        self.tell_cache = list(state["tell_cache"])
+        self._tell_cache_replaced()
+        self._pending_tells = list(dict.fromkeys([*state["pending_tells"], *self._pending_tells]))
+        self._full_range_spectra = dict(state["full_range_spectra"])
+
+    def save_checkpoint(self, path: Optional[str] = None):
+        """Write the agent state to a binary checkpoint file, replacing any previous checkpoint atomically.
+
+        Parameters
+        ----------
+        path : Optional[str]
+            File to write, by default ``checkpoint_path``
+        """
+        path = self.checkpoint_path if path is None else path
+        if path is None:
+            raise ValueError("No checkpoint path given or configured.")
+        payload = dict(
+            version=self._checkpoint_version,
+            signature=self.checkpoint_signature(),
+            state=self.checkpoint_state(),
+        )
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._tells_since_checkpoint = 0
+        logger.info(f"Checkpointed {len(self.tell_cache)} told runs to {path}")
+
+    def load_checkpoint(self, path: Optional[str] = None) -> bool:
+        """Restore the agent state from a checkpoint file.
+        Runs told before the checkpoint are then skipped by ``tell_agent_by_uid``.
+        Call this before ``start``, so that no document from the stream is told and then overwritten.
+
+        Parameters
+        ----------
+        path : Optional[str]
+            File to read, by default ``checkpoint_path``
+
+        Returns
+        -------
+        bool
+            False if there is no usable checkpoint, in which case the agent is left untouched
+        """
+        path = self.checkpoint_path if path is None else path
+        if path is None or not os.path.exists(path):
+            return False
+        try:
+            with open(path, "rb") as f:
+                payload = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint {path}: {e}")
+            return False
+        if payload.get("version") != self._checkpoint_version:
+            logger.warning(f"Ignoring checkpoint {path} written with format version {payload.get('version')}")
+            return False
+        if payload["signature"] != self.checkpoint_signature():
+            logger.warning(
+                f"Ignoring checkpoint {path}, as it was written with different parameters: {payload['signature']}"
+            )
+            return False
+        self.restore_checkpoint_state(payload["state"])
+        self._tells_since_checkpoint = 0
+        logger.info(f"Restored {len(self.tell_cache)} told runs from checkpoint {path}")
+        return True
+
+    def _checkpoint_if_due(self, force: bool = False):
+        if self.checkpoint_path is None or self._restarting:
+            return
+        if not force and self._tells_since_checkpoint < self.checkpoint_every:
+            return
+        try:
+            self.save_checkpoint()
+        except Exception as e:
+            logger.warning(f"Failed to write checkpoint to {self.checkpoint_path}: {e}")
+
+    def _tell(self, uid):
+        super()._tell(uid)
+        self._tells_since_checkpoint += 1
+        self._checkpoint_if_due()
+
+    def tell_many(self, xs: List[np.ndarray], ys: List[np.ndarray]) -> List[dict]:
+        """Tell the agent about a batch of observations, returning the tell document of each.
+        Agents that can update their model once for the whole batch override this."""
+        return [self.tell(x, y) for x, y in zip(xs, ys)]
+
+    def _tell_batch(self, uids: List[str], independents: List[np.ndarray], observables: List[np.ndarray]):
+        """Tell the agent about a batch of unpacked runs with one ``tell_many``, writing a tell event for each"""
+        if not uids:
+            return
+        docs = self.tell_many(independents, observables)
+        for uid, doc in zip(uids, docs):
+            doc["exp_uid"] = uid
+            self._write_event("tell", doc)
+        self.tell_cache.extend(uids)
+        self._tells_since_checkpoint += len(uids)
+
+    def _on_stop_router(self, name, doc):
+        """Queue each finished run that meets the trigger condition, to be told in a batch.
+        The queue is flushed once the Kafka consumer has no documents waiting, or when it reaches
+        ``max_tell_batch`` runs, so a backlog of stop documents costs one model update rather than one each."""
+        if name != "stop":
+            return
+
+        uid = doc["run_start"]
+        if not self.trigger_condition(uid):
+            logger.debug(
+                f"New data detected, but trigger condition not met. The agent will ignore this start doc: {uid}"
+            )
+            return
+
+        logger.info(f"New data detected, agent queueing this run uid to be told: {uid}")
+        self._pending_tells.append(uid)
+        if len(self._pending_tells) >= self.max_tell_batch:
+            self.flush_pending_tells()
+
+    def flush_pending_tells(self):
+        """Tell the agent about every queued run, then report and ask at most once for the whole batch.
+        A run that fails to unpack is dropped with a warning, as in ``bootstrap``. If the batch itself
+        fails to be told, its runs are left queued for the next flush."""
+        if not self._pending_tells:
+            return
+        uids = list(self._pending_tells)
+        told_uids, independents, observables = [], [], []
+        for uid in uids:
+            try:
+                x, y = self.unpack_run(self.exp_catalog[uid])
+            except Exception as e:
+                self._failed_tells += 1
+                logger.warning(f"Dropping {uid} from the tell batch after failing to unpack it:\n {e!r}")
+                continue
+            told_uids.append(uid)
+            independents.append(x)
+            observables.append(y)
+        try:
+            self._tell_batch(told_uids, independents, observables)
+        except Exception:
+            logger.exception(f"Failed to tell a batch of {len(told_uids)} runs, leaving them queued")
+            dropped = set(uids) - set(told_uids)
+            self._pending_tells = [uid for uid in self._pending_tells if uid not in dropped]
+            return
+        # Runs queued while the batch was told are kept for the next flush
+        self._pending_tells = self._pending_tells[len(uids) :]
+        if not told_uids:
+            return
+        logger.info(f"Agent told about a batch of {len(told_uids)} runs")
+
+        # Report
+        if self.report_on_tell:
+            self.generate_report(**self.default_report_kwargs)
+
+        # Ask
+        if self.ask_on_tell:
+            if self._direct_to_queue:
+                self.add_suggestions_to_queue(1)
+            else:
+                self.generate_suggestions_for_adjudicator(1)
+
+        self._post_tell_actions()
+        self._checkpoint_if_due()
+
+    def generate_report(self, force: bool = False, **kwargs):
+        """Report, unless held back by the ``report_policy``. A held report is left pending, to be made by
+        the next call the policy allows, or once it allows it while the Kafka consumer is idle, so that
+        reports held back in a burst of tells are coalesced into one.
+
+        Parameters
+        ----------
+        force : bool
+            Report regardless of the policy
+        """
+        if not force and not self._report_due():
+            logger.debug("Holding back report under the report policy")
+            self._pending_report = kwargs
+            return
+        self._pending_report = None
+        self._last_report_time = time.monotonic()
+        self._tells_at_last_report = len(self.tell_cache)
+        return super().generate_report(**kwargs)
+
+    def _report_due(self) -> bool:
+        policy = self._report_policy
+        if len(self.tell_cache) - self._tells_at_last_report < policy["every_n_tells"]:
+            return False
+        if (
+            self._last_report_time is not None
+            and time.monotonic() - self._last_report_time < policy["min_interval"]
+        ):
+            return False
+        if policy["center_tolerance"] is not None and not self.report_changed(policy["center_tolerance"]):
+            return False
+        return True
+
+    def _tell_cache_replaced(self):
+        """Count tells toward the report policy afresh, after the tell cache was cleared or replaced"""
+        self._tells_at_last_report = 0
+
+    def report_changed(self, tolerance: float) -> bool:
+        """Whether the model has changed by more than ``tolerance`` since the last report.
+        Agents with a notion of this override it."""
+        return True
+
+    def flush_pending_report(self):
+        """Make a report held back by the report policy, if the policy now allows it"""
+        if self._pending_report is not None and self._report_due():
+            self.generate_report(**self._pending_report)
+
+    def _work_during_wait(self):
+        # Called from the Kafka consumer loop, which an exception would bring down
+        try:
+            self.flush_pending_tells()
+            self.flush_pending_report()
+        except Exception:
+            logger.exception("Failed to flush queued tells and reports while waiting for documents")
+
+    def _post_tell_actions(self):
+        """Called after each batch of runs has been told, reported, and asked about"""
+        pass
+
+    def start(self, *args, **kwargs):
+        # Flush queued tells and held reports whenever the consumer has caught up with the documents waiting
+        if not isinstance(self.kafka_consumer.start, partial):
+            self.kafka_consumer.start = partial(self.kafka_consumer.start, work_during_wait=self._work_during_wait)
+        return super().start(*args, **kwargs)
+
+    def tell_agent_by_uid(self, uids: Iterable):
+        """Tell the agent about runs, skipping any it has already been told,
+        such as those restored from a checkpoint."""
+        told = set(self.tell_cache)
+        new, skipped = [], 0
+        for uid in uids:
+            if uid in told:
+                skipped += 1
+                continue
+            told.add(uid)
+            new.append(uid)
+        if skipped:
+            logger.info(f"Skipping {skipped} runs the agent has already been told")
+        return super().tell_agent_by_uid(new)
+
+    @property
+    def bootstrap_status(self) -> Dict[str, Any]:
+        """Progress and timing of the most recent ``bootstrap``"""
+        return dict(self._bootstrap_status)
+
+    def bootstrap(
+        self,
+        uids: Iterable[str],
+        workers: Optional[int] = None,
+        io_workers: int = 8,
+        parallel_threshold: int = 64,
+    ) -> Dict[str, Any]:
+        """Tell the agent about a history of runs as one batch, such as when starting up.
+
+        Repeated uids, and those already told, are dropped. The remaining runs are read from the spectrum
+        cache where possible, and otherwise prefetched from tiled over a thread pool. Spectra that need
+        processing are then run through Larch, over a process pool when there are enough of them to be
+        worth starting one, and everything is told with a single ``tell_many``, followed by at most one report.
+
+        Parameters
+        ----------
+        uids : Iterable[str]
+            Runs to tell the agent about, in order
+        workers : Optional[int]
+            Number of processes used for Larch, by default ``os.cpu_count()``
+        io_workers : int
+            Number of threads used to read from tiled, by default 8
+        parallel_threshold : int
+            Fewest spectra to process for which a process pool is used, by default 64.
+            Smaller batches are processed in this process, as each pool worker pays for importing Larch.
+
+        Returns
+        -------
+        Dict[str, Any]
+            Final ``bootstrap_status``
+        """
+        t0 = time.perf_counter()
+        told = set(self.tell_cache)
+        requested = list(uids)
+        uids = [uid for uid in dict.fromkeys(requested) if uid not in told]
+        status = self._bootstrap_status = dict(
+            state="fetching",
+            requested=len(requested),
+            total=len(uids),
+            fetched=0,
+            cached=0,
+            processed=0,
+            told=0,
+            failed=0,
+            timings={},
+        )
+        spectra, raws = {}, {}
+
+        def fetch(uid):
+            entry = self.cached_spectrum(uid)
+            if entry is not None:
+                return entry, None
+            run = self.exp_catalog[uid]
+            return None, self.raw_run(run, Pandrosus.xmu_columns(run.start, self.read_mode))
+
+        with ThreadPoolExecutor(max_workers=io_workers) as pool:
+            futures = {pool.submit(fetch, uid): uid for uid in uids}
+            for future in as_completed(futures):
+                uid = futures[future]
+                try:
+                    entry, raw = future.result()
+                except Exception as e:
+                    logger.warning(f"Dropping {uid} from bootstrap after failing to read it:\n {e!r}")
+                    status["failed"] += 1
+                    continue
+                if entry is not None:
+                    spectra[uid] = entry
+                    status["cached"] += 1
+                else:
+                    raws[uid] = raw
+                status["fetched"] += 1
+        status["timings"]["fetch"] = time.perf_counter() - t0
+
+        t1 = time.perf_counter()
+        status["state"] = "processing"
+        pending = [uid for uid in uids if uid in raws]
+        if len(pending) < parallel_threshold or workers == 1:
+            for uid in pending:
+                try:
+                    spectra[uid] = self._process_raw(raws[uid])
+                except Exception as e:
+                    logger.warning(f"Dropping {uid} from bootstrap after failing to process it:\n {e!r}")
+                    status["failed"] += 1
+                    continue
+                status["processed"] += 1
+        else:
+            preprocessors, _ = Pandrosus.prepare_many(
+                [raws[uid] for uid in pending],
+                mode=self.read_mode,
+                workers=workers,
+                tables=[raws[uid].table for uid in pending],
+                stage=Pandrosus.stage_for(self.spectrum_needs()),
+                fast_norm=self.fast_norm,
+            )
+            for uid, preprocessor in zip(pending, preprocessors):
+                if preprocessor is None:
+                    status["failed"] += 1
+                    continue
+                spectra[uid] = self._keep_spectrum(preprocessor, raws[uid])
+                status["processed"] += 1
+        status["timings"]["process"] = time.perf_counter() - t1
+
+        t2 = time.perf_counter()
+        status["state"] = "telling"
+        told_uids, independents, observables = [], [], []
+        for uid in uids:
+            if uid not in spectra:
+                continue
+            try:
+                x, y = self.observation(uid, *spectra[uid])
+            except KeyError as e:
+                logger.warning(f"Dropping {uid} from bootstrap after key error in unpack:\n {e}")
+                status["failed"] += 1
+                continue
+            told_uids.append(uid)
+            independents.append(x)
+            observables.append(y)
+        self._tell_batch(told_uids, independents, observables)
+        if told_uids and self.report_on_tell:
+            self.generate_report(**self.default_report_kwargs)
+        status["told"] = len(told_uids)
+        status["timings"]["tell"] = time.perf_counter() - t2
+        status["timings"]["total"] = time.perf_counter() - t0
+        status["state"] = "done"
+        logger.info(
+            f"Bootstrapped {status['told']} of {status['total']} runs "
+            f"({status['cached']} cached, {status['failed']} failed) in {status['timings']['total']:.1f} s"
+        )
+        self._checkpoint_if_due(force=True)
+        return self.bootstrap_status
+
+    def stop(self, exit_status="success", reason=""):
+        if not self._restarting:
+            # Runs still queued would otherwise never be told
+            try:
+                self.flush_pending_tells()
+            except Exception:
+                logger.exception("Failed to flush queued tells on stop")
+        self._checkpoint_if_due(force=True)
+        return super().stop(exit_status=exit_status, reason=reason)
+
     def unpack_run(self, run):
-        """Gets Chi(k) and absolute motor position"""
-        run_preprocessor = Pandrosus()
-        run_preprocessor.fetch(run, mode=self.read_mode)
-        y = getattr(run_preprocessor.group, self.exp_data_type)
-        if self.roi is not None:
-            ordinate = getattr(run_preprocessor.group, self._ordinate)
-            idx_min = np.where(ordinate < self.roi[0])[0][-1] if len(np.where(ordinate < self.roi[0])[0]) else None
-            idx_max = np.where(ordinate > self.roi[1])[0][-1] if len(np.where(ordinate > self.roi[1])[0]) else None
-            y = y[idx_min:idx_max]
-        return np.array([run.baseline.data[key][0] for key in self._variable_motor_names]), y
+        """Gets Chi(k) and absolute motor position.
+        When resampling, the spectrum is interpolated onto ``ordinate_grid`` so all observables share a shape.
+        The full range spectrum is kept, so that changes to the roi do not need a retell."""
+        arrays, positions = self.processed_spectrum(run)
+        return self.observation(run.start["uid"], arrays, positions)
+
+    def observation(self, uid: str, arrays: dict, positions: dict) -> Tuple[np.ndarray, np.ndarray]:
+        """Independent and observable variables from the processed arrays and baseline positions of a run"""
+        y = arrays[self.exp_data_type]
+        ordinate = arrays["k"] if self.exp_data_type == "chi" else arrays["energy"] - arrays["e0"]
+        if self.resample_to_exp_grid:
+            y = resample(ordinate, y, self.ordinate_grid)
+            ordinate = self.ordinate_grid
+        self._full_range_spectra[uid] = (ordinate, y)
+        return np.array([positions[key] for key in self._variable_motor_names]), y[self.roi_slice(ordinate)]
 
     def measurement_plan(self, relative_point: ArrayLike) -> Tuple[str, List, dict]:
         """Works from relative points"""
@@ -279,3 +990,10 @@ class BMMBaseAgent(Agent, ABC):
             ),
             qserver=qs,
         )
+
+
+@lru_cache(maxsize=8)
+def _exp_grid(exp_data_type: str, exp_bounds: str, exp_steps: str) -> np.ndarray:
+    grid = exp_k_grid(exp_bounds, exp_steps) if exp_data_type == "chi" else exp_energy_grid(exp_bounds, exp_steps)
+    grid.flags.writeable = False
+    return grid
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SpectrumCache:
+    """Content-addressed on-disk cache of processed spectra.
+
+    Each entry is an ``.npz`` file named by a hash of the run uid, the read mode, and the
+    processing parameters, so a change in any of them is a cache miss rather than stale data.
+    Entries hold the processed arrays (energy, mu, e0, norm, k, chi) and the baseline motor positions.
+    The directory is bounded in size, evicting the least recently used entries first.
+
+    Parameters
+    ----------
+    directory : str
+        Directory in which to keep the cache. Created if it does not exist.
+    max_bytes : int
+        Upper bound on the total size of the cache on disk, by default 1 GiB.
+    """
+
+    fields = ("energy", "mu", "e0", "norm", "k", "chi")
+    _position_prefix = "position:"
+
+    def __init__(self, directory: str, max_bytes: int = 2**30):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._sizes = {path: path.stat().st_size for path in self.directory.glob("*.npz")}
+
+    @staticmethod
+    def key(uid: str, mode: str, pre: dict, bkg: dict, fft: dict, **options) -> str:
+        """Hash identifying a run processed with a given read mode, set of Larch parameters,
+        and any other processing options"""
+        payload = json.dumps(
+            dict(uid=uid, mode=mode, pre=pre, bkg=bkg, fft=fft, **options), sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.npz"
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, np.ndarray], Dict[str, float]]]:
+        """Load an entry, returning None on a miss.
+
+        Returns
+        -------
+        arrays : Dict[str, np.ndarray]
+            Processed arrays by field name
+        positions : Dict[str, float]
+            Baseline motor positions by motor name
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                contents = {name: npz[name] for name in npz.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable spectrum cache entry {path}: {e}")
+            self._remove(path)
+            return None
+        os.utime(path)  # Mark as recently used
+        arrays = {name: value for name, value in contents.items() if not name.startswith(self._position_prefix)}
+        positions = {
+            name[len(self._position_prefix) :]: float(value)
+            for name, value in contents.items()
+            if name.startswith(self._position_prefix)
+        }
+        return arrays, positions
+
+    def put(self, key: str, arrays: Dict[str, np.ndarray], positions: Dict[str, float]):
+        """Write an entry, then evict old entries if the cache has outgrown ``max_bytes``."""
+        contents = {name: np.asarray(value) for name, value in arrays.items()}
+        contents.update({f"{self._position_prefix}{name}": np.asarray(value) for name, value in positions.items()})
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **contents)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._sizes[path] = path.stat().st_size
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in ``max_bytes``."""
+        total = self.nbytes
+        if total <= self.max_bytes:
+            return
+        by_age = sorted(self._sizes, key=lambda path: path.stat().st_mtime if path.exists() else 0.0)
+        for path in by_age:
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes[path]
+            self._remove(path)
+
+    def clear(self):
+        for path in list(self._sizes):
+            self._remove(path)
+
+    def _remove(self, path: Path):
+        self._sizes.pop(path, None)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
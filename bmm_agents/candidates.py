@@ -0,0 +1,229 @@
+"""Candidate points for the agents to suggest, on the lattice of ``min_step_size`` spaced points over a wafer"""
+
+import logging
+from functools import cached_property, lru_cache
+from typing import Callable, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .utils import lattice_codes
+
+logger = logging.getLogger(__name__)
+
+
+def lattice_shape(bounds: Sequence[float], step: float) -> tuple:
+    """Number of lattice points along each axis, matching ``np.arange(lower, upper, step)``.
+    Bounds are flat, as (x_min, x_max, y_min, y_max)."""
+    lower, upper = np.asarray(bounds, dtype=float).reshape(-1, 2).T
+    return tuple(int(n) for n in np.ceil((upper - lower) / step))
+
+
+def lattice_points(bounds: Sequence[float], step: float, indices: np.ndarray) -> np.ndarray:
+    """Coordinates of integer lattice indices"""
+    lower = np.asarray(bounds, dtype=float).reshape(-1, 2)[:, 0]
+    return lower + indices * step
+
+
+def in_wafer(bounds: Sequence[float], points: np.ndarray) -> np.ndarray:
+    """Whether points lie within the circle inscribed in the bounds, as in ``make_wafer_grid_list``"""
+    x_min, x_max, y_min, y_max = np.asarray(bounds, dtype=float)
+    center = np.array([x_min + (x_max - x_min) / 2, y_min + (y_max - y_min) / 2])
+    radius = min((x_max - x_min) / 2, (y_max - y_min) / 2)
+    return np.sqrt((points[:, 0] - center[0]) ** 2 + (points[:, 1] - center[1]) ** 2) < radius
+
+
+def wafer_lattice_indices(bounds: Sequence[float], step: float, factor: int = 1) -> np.ndarray:
+    """Integer indices of every ``factor``-th lattice point along each axis that lies on the wafer.
+    With a factor of 1 these are the points of ``make_wafer_grid_list``."""
+    nx, ny = lattice_shape(bounds, step)
+    ii, jj = np.meshgrid(np.arange(0, nx, factor), np.arange(0, ny, factor), indexing="ij")
+    indices = np.column_stack([ii.ravel(), jj.ravel()])
+    return indices[in_wafer(bounds, lattice_points(bounds, step, indices))]
+
+
+class CandidateGrid:
+    """Read-only lattice of candidate points, every ``factor``-th point of the ``step`` lattice along each axis.
+
+    In 1d these are the points of ``np.arange(lower, upper, step)``, and in 2d those on the wafer, as in
+    ``make_wafer_grid_list``. Along with the points, the grid keeps their integer lattice indices and the
+    ``lattice_codes`` of their cells, so that matching other positions against the grid is a ``searchsorted``
+    rather than a comparison of floats. Shared grids come from :func:`candidate_grid`.
+
+    Parameters
+    ----------
+    bounds : Sequence[float]
+        Bounds as (lower, upper) in 1d, or (x_min, x_max, y_min, y_max) in 2d
+    step : float
+        Lattice spacing
+    factor : int
+        Stride through the lattice, by default every point
+    """
+
+    def __init__(self, bounds: Sequence[float], step: float, factor: int = 1):
+        self.bounds = tuple(float(bound) for bound in np.ravel(bounds))
+        self.step = float(step)
+        self.factor = factor
+        self.shape = lattice_shape(self.bounds, self.step)
+        if len(self.shape) == 1:
+            self.indices = np.arange(0, self.shape[0], factor)[:, None]
+        else:
+            self.indices = wafer_lattice_indices(self.bounds, self.step, factor)
+        self.points = lattice_points(self.bounds, self.step, self.indices)
+        if len(self.shape) == 1:
+            self.points = self.points[:, 0]
+        for array in (self.indices, self.points):
+            array.flags.writeable = False
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def __repr__(self) -> str:
+        return f"CandidateGrid(bounds={self.bounds}, step={self.step}, factor={self.factor}, points={len(self)})"
+
+    @cached_property
+    def cell_codes(self) -> np.ndarray:
+        """``lattice_codes`` of the points at the grid step, which are the cells a knowledge cache keeps"""
+        codes = lattice_codes(self.points, self.step)
+        codes.flags.writeable = False
+        return codes
+
+    @cached_property
+    def _cell_order(self) -> Tuple[np.ndarray, np.ndarray]:
+        order = np.argsort(self.cell_codes, kind="stable")
+        return order, self.cell_codes[order]
+
+    def cell_matches(self, codes: np.ndarray) -> np.ndarray:
+        """Positions in the grid of the points lying in any of the cells with the given ``lattice_codes``"""
+        order, sorted_codes = self._cell_order
+        codes = np.asarray(codes, dtype=np.int64)
+        start = np.searchsorted(sorted_codes, codes, side="left")
+        counts = np.searchsorted(sorted_codes, codes, side="right") - start
+        # Rounding can put neighbouring points in one cell, so gather each run of matches
+        runs = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return order[runs]
+
+
+@lru_cache(maxsize=8)
+def candidate_grid(bounds: Tuple[float, ...], step: float, factor: int = 1) -> CandidateGrid:
+    """Candidate grid shared by every caller with the same (hashable) bounds, step, and factor"""
+    return CandidateGrid(bounds, step, factor)
+
+
+def _grid_key(bounds: Sequence[float], step: float) -> Tuple[Tuple[float, ...], float]:
+    return tuple(float(bound) for bound in np.ravel(bounds)), float(step)
+
+
+def _coarsest_factor(bounds: Sequence[float], step: float, max_candidates: int) -> int:
+    nx, ny = lattice_shape(bounds, step)
+    factor = 1
+    while -(-nx // factor) * -(-ny // factor) > max_candidates:
+        factor *= 2
+    return factor
+
+
+def top_k(scores: np.ndarray, k: int, exclude: Optional[np.ndarray] = None) -> np.ndarray:
+    """Indices of the k highest scores, highest first, passing over any that are excluded.
+    Linear in the number of scores, rather than a full sort.
+
+    Parameters
+    ----------
+    scores : np.ndarray
+        Scores of each candidate, higher being better
+    k : int
+        Number of indices to return, or fewer if fewer candidates remain
+    exclude : Optional[np.ndarray]
+        Boolean mask of candidates that may not be chosen
+    """
+    if exclude is not None:
+        allowed = np.flatnonzero(~exclude)
+        return allowed[top_k(scores[allowed], k)]
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=int)
+    top = np.argpartition(scores, len(scores) - k)[len(scores) - k :]
+    return top[np.argsort(scores[top])[::-1]]
+
+
+def wafer_top_k(
+    score: Callable[[np.ndarray], np.ndarray],
+    bounds: Sequence[float],
+    step: float,
+    k: int,
+    max_candidates: int = 2**16,
+    exclude: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+) -> np.ndarray:
+    """Highest scoring points of the wafer lattice, searched coarse to fine.
+
+    When the full lattice holds more than ``max_candidates`` points, a sub-lattice small enough is scored
+    first. Windows around its best points are then scored on successively finer sub-lattices, until the
+    windows are on the lattice itself. No more than about ``max_candidates`` points are scored at once,
+    however small the step, and the points returned are always on the ``step`` lattice.
+
+    Excluded points are ranked last at every level, so windows are refined around points that may be
+    returned. Should the windows still hold fewer than k points that are not excluded, the search is
+    repeated from the next best regions of the coarsest level, until k are found or none are left.
+
+    Parameters
+    ----------
+    score : Callable[[np.ndarray], np.ndarray]
+        Scores for an (n, 2) array of points, higher being better
+    bounds : Sequence[float]
+        Bounds as (x_min, x_max, y_min, y_max)
+    step : float
+        Lattice spacing
+    k : int
+        Number of points to return
+    max_candidates : int
+        Bound on the number of points scored at once
+    exclude : Optional[Callable[[np.ndarray], np.ndarray]]
+        Mask of lattice points that may not be returned, such as those already measured
+
+    Returns
+    -------
+    np.ndarray
+        Up to k points, best first
+    """
+    bounds, step = _grid_key(bounds, step)
+
+    def ranked(points):
+        """Scores of points, with excluded points ranked below all others, and which are excluded"""
+        scores = np.asarray(score(points), dtype=float)
+        if exclude is None:
+            return scores, np.zeros(len(points), dtype=bool)
+        excluded = np.asarray(exclude(points), dtype=bool)
+        return np.where(excluded, -np.inf, scores), excluded
+
+    coarsest = _coarsest_factor(bounds, step, max_candidates)
+    grid = candidate_grid(bounds, step, coarsest)
+    coarse_scores, excluded = ranked(grid.points)
+    if coarsest == 1:
+        return grid.points[top_k(coarse_scores, k, excluded)]
+    # Keep enough regions that excluded points near the best do not starve the final selection, but no more
+    # than the smallest windows, of 5 x 5 points, fit within max_candidates
+    n_regions = min(max(4 * k, 16), max(1, max_candidates // 25))
+    searched = np.zeros(len(grid), dtype=bool)
+    found_indices, found_scores = np.empty((0, 2), dtype=int), np.empty(0)
+    while len(found_indices) < k and not searched.all():
+        picks = top_k(coarse_scores, n_regions, searched)
+        searched[picks] = True
+        regions, factor = grid.indices[picks], coarsest
+        while factor > 1:
+            # Refine by as much as keeps the windows around every region within max_candidates points
+            ratio = max(2, int((np.sqrt(max_candidates / len(regions)) - 1) // 2))
+            finer = max(1, factor >> int(np.log2(ratio)))  # Factors stay powers of two, so each level nests
+            offsets = np.arange(-factor, factor + 1, finer)
+            window = np.stack(np.meshgrid(offsets, offsets, indexing="ij"), axis=-1).reshape(-1, 2)
+            indices = np.unique((regions[:, None, :] + window[None, :, :]).reshape(-1, 2), axis=0)
+            indices = indices[((indices >= 0) & (indices < np.array(grid.shape))).all(axis=1)]
+            points = lattice_points(bounds, step, indices)
+            on_wafer = in_wafer(bounds, points)
+            indices, points = indices[on_wafer], points[on_wafer]
+            scores, excluded = ranked(points)
+            regions = indices[top_k(scores, n_regions)]
+            factor = finer
+        # Windows of different rounds may overlap, so keep each point found once
+        found_indices, first = np.unique(
+            np.concatenate([found_indices, indices[~excluded]]), axis=0, return_index=True
+        )
+        found_scores = np.concatenate([found_scores, scores[~excluded]])[first]
+    return lattice_points(bounds, step, found_indices[top_k(found_scores, k)])
@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, Iterable, List, Sequence, Tuple
+from typing import Dict, List, Sequence, Tuple
 
 import numpy as np
 from bluesky_adaptive.agents.base import MonarchSubjectAgent
@@ -34,20 +34,29 @@ class KMeansMonarchSubject(MonarchSubjectAgent, MultiElementActiveKmeansAgent):
 
     def subject_ask(self, batch_size: int) -> Tuple[Sequence[Dict[str, ArrayLike]], Sequence[ArrayLike]]:
         suggestions, centers = self._sample_uncertainty_proxy(batch_size)
-        if not isinstance(suggestions, Iterable):
-            suggestions = [suggestions]
+        # Share the knowledge cache with the XAS asks, so neither suggests a point the other has
+        kept_suggestions = self._keep_new_suggestions(suggestions)
         _default_doc = dict(
             cluster_centers=centers,
-            cache_len=(
-                len(self.independent_cache)
-                if isinstance(self.independent_cache, list)
-                else self.independent_cache.shape[0]
-            ),
+            cache_len=len(self.independent_cache),
             latest_data=self.tell_cache[-1],
             requested_batch_size=batch_size,
+            redundant_points_discarded=batch_size - len(kept_suggestions),
         )
-        docs = [dict(suggestion=suggestion, **_default_doc) for suggestion in suggestions]
-        return docs, suggestions
+        docs = [dict(suggestion=suggestion, **_default_doc) for suggestion in kept_suggestions]
+        return docs, kept_suggestions
 
     def subject_ask_condition(self):
         return True
+
+    def _on_stop_router(self, name, doc):
+        # Skip MonarchSubjectAgent's router, so the subject is asked once each batch of runs has been told
+        return MultiElementActiveKmeansAgent._on_stop_router(self, name, doc)
+
+    def _post_tell_actions(self):
+        super()._post_tell_actions()
+        if self.subject_ask_condition():
+            if self._direct_to_queue:
+                self.add_suggestions_to_subject_queue(1)
+            else:
+                raise NotImplementedError
@@ -1,43 +1,259 @@
 import logging
-from typing import Iterable
+from typing import Callable, Iterable, Literal, Optional, Tuple, Union
 
 import numpy as np
 from bluesky_adaptive.agents.sklearn import ClusterAgentBase
 from bluesky_adaptive.server import register_variable
-from numpy.polynomial.polynomial import polyfit, polyval
 from numpy.typing import ArrayLike
-from scipy.stats import rv_discrete
-from sklearn.cluster import KMeans
-from sklearn.linear_model import LinearRegression
+from scipy.spatial.distance import cdist
+from sklearn.base import clone
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
 from .base import BMMBaseAgent
-from .utils import discretize, make_hashable, make_wafer_grid_list
+from .candidates import CandidateGrid, candidate_grid, lattice_shape, top_k, wafer_top_k
+from .surrogates import Surrogate, make_surrogate
+from .utils import GrowableArray, KnowledgeCache, discretize, make_hashable, min_distances
 
 logger = logging.getLogger(__name__)
 
 
 class PassiveKmeansAgent(BMMBaseAgent, ClusterAgentBase):
-    def __init__(self, k_clusters, analyzed_element, *args, **kwargs):
+    clustering_modes = ("full", "warm", "minibatch")
+
+    def __init__(
+        self,
+        k_clusters,
+        analyzed_element,
+        *args,
+        cache_dtype=np.float64,
+        clustering_mode: Literal["full", "warm", "minibatch"] = "full",
+        refit_every: int = 20,
+        inertia_tolerance: float = 0.2,
+        landscape_tolerance: float = 0.0,
+        **kwargs,
+    ):
+        """
+        Parameters
+        ----------
+        k_clusters : int
+            Number of clusters
+        analyzed_element : str
+            Element whose spectra are clustered
+        cache_dtype : np.typing.DTypeLike
+            Type the observable cache is held as, by default float64
+        clustering_mode : Literal["full", "warm", "minibatch"]
+            How the model is updated when spectra are told. "full" refits from scratch with every random
+            init. "warm" refits once, seeded from the previous centers. "minibatch" updates the previous
+            centers from only the new spectra with ``MiniBatchKMeans.partial_fit``.
+        refit_every : int
+            In the warm and minibatch modes, number of incremental updates before a full refit
+        inertia_tolerance : float
+            In the warm and minibatch modes, fractional growth in the inertia per spectrum, relative to the
+            last full refit, at which a full refit is made instead of an incremental update
+        landscape_tolerance : float
+            Distance every cluster center may move before the cached distance of each spectrum to its nearest
+            center is recomputed. Until then only new spectra are computed, and each cached distance is off
+            by at most this much. By default 0, recomputing whenever the centers change.
+        """
         estimator = KMeans(k_clusters)
         _default_kwargs = self.get_beamline_objects()
         _default_kwargs.update(kwargs)
 
         super().__init__(*args, estimator=estimator, **kwargs)
         self._element_idx = self.elements.index(analyzed_element)
+        self.cache_dtype = np.dtype(cache_dtype)  # Observables may be held as float32 to halve the cache
+        self.clustering_mode = clustering_mode
+        self.refit_every = refit_every
+        self.inertia_tolerance = inertia_tolerance
+        self.landscape_tolerance = landscape_tolerance
+        self.data_version = 0  # Incremented on every change to the caches
+        self._reported_centers = None
+        self._memo = {}
+        self.clear_caches()
 
     @property
     def name(self):
         return "BMMPassiveKMeans"
 
+    @property
+    def clustering_mode(self):
+        return self._clustering_mode
+
+    @clustering_mode.setter
+    def clustering_mode(self, value: Literal["full", "warm", "minibatch"]):
+        if value not in self.clustering_modes:
+            raise ValueError(f"Unknown clustering mode {value}, expected one of {self.clustering_modes}")
+        self._clustering_mode = value
+        self._invalidate_model()
+
+    def _invalidate_model(self):
+        """Force a full refit, and drop everything memoized from the model, without a change in the data"""
+        self._fitted_version = None
+        self._full_refit_due = True
+        self._memo = {}
+
+    def update_model_params(self, params: dict):
+        self._invalidate_model()
+        return super().update_model_params(params)
+
     def clear_caches(self):
-        self.independent_cache = []
-        self.dependent_cache = []
+        self.independent_cache = GrowableArray()
+        self.observable_cache = GrowableArray(dtype=self.cache_dtype)
+        self._data_changed(full_refit=True)
+
+    def _data_changed(self, full_refit=False):
+        """Move to a new data version, invalidating everything memoized for the last one.
+        ``full_refit`` marks that the caches were replaced, so the next fit cannot build on the last one."""
+        self.data_version += 1
+        if full_refit:
+            self._full_refit_due = True
+            self._landscape = None
+
+    def _memoized(self, name, compute, *key):
+        """Value of ``compute()``, computed at most once per data version and key, so that report, ask,
+        and subject_ask within one version share the work"""
+        version = (self.data_version, key)
+        if name in self._memo and self._memo[name][0] == version:
+            return self._memo[name][1]
+        value = compute()
+        self._memo[name] = (version, value)
+        return value
+
+    def tell(self, x, y):
+        self._data_changed()
+        return super().tell(x, y)
+
+    def tell_many(self, xs, ys):
+        """Append a batch of observations to the caches at once"""
+        start = len(self.independent_cache)
+        self.independent_cache.extend(xs)
+        self.observable_cache.extend(ys)
+        self._data_changed()
+        return [
+            dict(independent_variable=x, observable=y, cache_len=start + i + 1)
+            for i, (x, y) in enumerate(zip(xs, ys))
+        ]
+
+    def _fit_model(self):
+        """Fit the model to the observable cache, unless it was already fit to this data version.
+        Outside the full clustering mode, the last fit is updated incrementally where it can be."""
+        if self._fitted_version == self.data_version:
+            return
+        observables = self.observable_cache.view
+        if (
+            self.clustering_mode != "full"
+            and not self._full_refit_due
+            and self._incremental_fits < self.refit_every
+            and len(observables) > self._fitted_rows
+        ):
+            inertia = self._incremental_fit(observables)
+            if inertia <= self._baseline_inertia * (1 + self.inertia_tolerance):
+                self._incremental_fits += 1
+                self._fitted_rows = len(observables)
+                self._fitted_version = self.data_version
+                return
+            logger.info(f"Inertia per spectrum grew from {self._baseline_inertia:.4g} to {inertia:.4g}, refitting")
+        self._full_fit(observables)
+
+    def _full_fit(self, observables):
+        self.model.fit(observables)
+        self._mark_fitted(observables)
+
+    def _mark_fitted(self, observables):
+        """Take the model as a full fit to the observables, and the baseline for incremental updates"""
+        self._baseline_inertia = self.model.inertia_ / len(observables)
+        if self.clustering_mode == "minibatch":
+            self._minibatch_model = MiniBatchKMeans(
+                n_clusters=self.model.n_clusters, init=self.model.cluster_centers_, n_init=1
+            ).partial_fit(observables)
+        self._incremental_fits = 0
+        self._fitted_rows = len(observables)
+        self._full_refit_due = False
+        self._fitted_version = self.data_version
+
+    def _incremental_fit(self, observables) -> float:
+        """Update the model from the previous centers, returning the inertia per spectrum
+        of the spectra it was updated with"""
+        if self.clustering_mode == "warm":
+            params = self.model.get_params()
+            model = clone(self.model).set_params(init=self.model.cluster_centers_, n_init=1).fit(observables)
+            self.model = model.set_params(init=params["init"], n_init=params["n_init"])
+            return self.model.inertia_ / len(observables)
+        new = observables[self._fitted_rows :]
+        self._minibatch_model.partial_fit(new)
+        self.model.cluster_centers_ = self._minibatch_model.cluster_centers_.copy()
+        return float(np.mean(self.model.transform(new).min(axis=1) ** 2))
+
+    def distances(self) -> np.ndarray:
+        """Distance of every told spectrum from each cluster center, for the current data version"""
+        self._fit_model()
+        return self._memoized("distances", lambda: self.model.transform(self.observable_cache.view))
+
+    def min_landscape(self) -> np.ndarray:
+        """Distance of every told spectrum from its nearest cluster center, for the current data version.
+        Kept between versions, computing only newly told spectra while the centers stay within the
+        landscape tolerance of those it was computed from."""
+        self._fit_model()
+        return self._memoized("min_landscape", self._update_landscape)
+
+    def _update_landscape(self) -> np.ndarray:
+        observables = self.observable_cache.view
+        centers = self.model.cluster_centers_
+        if (
+            self._landscape is None
+            or len(self._landscape) > len(observables)
+            or centers.shape != self._landscape_centers.shape
+            or np.linalg.norm(centers - self._landscape_centers, axis=1).max() > self.landscape_tolerance
+        ):
+            self._landscape = GrowableArray(min_distances(observables, centers), dtype=self.cache_dtype)
+            self._landscape_centers = centers.copy()
+        elif len(self._landscape) < len(observables):
+            self._landscape.extend(min_distances(observables[len(self._landscape) :], self._landscape_centers))
+        return self._landscape.view
 
     def close_and_restart(self, *, clear_tell_cache=False, retell_all=False, reason=""):
         if clear_tell_cache:
             self.clear_caches()
         return super().close_and_restart(clear_tell_cache=clear_tell_cache, retell_all=retell_all, reason=reason)
 
+    def replace_observables(self, observables):
+        if len(observables) != len(self.observable_cache):
+            return False
+        self.observable_cache = GrowableArray(observables, dtype=self.cache_dtype)
+        self._data_changed(full_refit=True)
+        return True
+
+    def replace_observations(self, uids, independents, observables):
+        self.clear_caches()
+        self.tell_many(independents, observables)
+        self.tell_cache = list(uids)
+        self._tell_cache_replaced()
+        return True
+
+    def checkpoint_signature(self):
+        return dict(super().checkpoint_signature(), analyzed_element_and_edge=self.analyzed_element_and_edge)
+
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        state.update(
+            independent_cache=np.array(self.independent_cache),
+            observable_cache=np.array(self.observable_cache),
+            model=self.model,
+            # Number of observables the model is a current fit to, if it is one
+            model_rows=self._fitted_rows if self._fitted_version == self.data_version else None,
+        )
+        return state
+
+    def restore_checkpoint_state(self, state):
+        super().restore_checkpoint_state(state)
+        self.independent_cache = GrowableArray(state["independent_cache"])
+        self.observable_cache = GrowableArray(state["observable_cache"], dtype=self.cache_dtype)
+        self.model = state["model"]
+        self._data_changed(full_refit=True)
+        if len(self.observable_cache) and state.get("model_rows") == len(self.observable_cache):
+            # The checkpointed model was fit to the restored observables, so it is kept rather than refit
+            self._mark_fitted(self.observable_cache.view)
+
     @property
     def analyzed_element_and_edge(self):
         return (self.elements[self._element_idx], self.edges[self._element_idx])
@@ -46,17 +262,24 @@ class PassiveKmeansAgent(BMMBaseAgent, ClusterAgentBase):
     def analyzed_element_and_edge(self, value):
         if isinstance(value, int):
             self._element_idx = value
-            self.close_and_restart(clear_tell_cache=True, reason="Parameter Change")
         elif isinstance(value, str):
             logger.info("Changing analyzed element and assuming edge")
             self._element_idx = self.elements.index(value)
-            self.close_and_restart(clear_tell_cache=True, reason="Parameter Change")
         else:
             logger.warning("Invalid element or index passed to setter. No change made in analyzed element.")
+            return
+        # Keep the told runs that are of the newly analyzed element
+        element = self.analyzed_element_and_edge[0]
+        self.rederive_or_clear(
+            uids=[uid for uid in self.tell_cache if self.run_start(uid)["XDI"]["Element"]["symbol"] == element],
+            reason="Parameter Change",
+        )
 
     def server_registrations(self) -> None:
         self._register_method("clear_caches")
         self._register_property("analyzed_element_and_edge")
+        self._register_property("clustering_mode")
+        self._register_property("landscape_tolerance")
         return super().server_registrations()
 
     def trigger_condition(self, uid) -> bool:
@@ -66,9 +289,19 @@ class PassiveKmeansAgent(BMMBaseAgent, ClusterAgentBase):
             and self.exp_catalog[uid].start["XDI"]["Element"]["symbol"] == self.analyzed_element_and_edge[0]
         )
 
+    def report_changed(self, tolerance):
+        """Whether any cluster center has moved more than ``tolerance`` from every center last reported"""
+        if self._reported_centers is None or len(self.observable_cache) < self.model.n_clusters:
+            return True
+        self._fit_model()
+        centers = self.model.cluster_centers_
+        if centers.shape != self._reported_centers.shape:
+            return True
+        return bool(cdist(centers, self._reported_centers).min(axis=1).max() > tolerance)
+
     def report(self, **kwargs):
-        arr = np.array(self.observable_cache)
-        self.model.fit(arr)
+        self._fit_model()
+        self._reported_centers = self.model.cluster_centers_.copy()
         return dict(
             cluster_centers=self.model.cluster_centers_,
             cache_len=len(self.independent_cache),
@@ -77,11 +310,28 @@ class PassiveKmeansAgent(BMMBaseAgent, ClusterAgentBase):
 
 
 class ActiveKmeansAgent(PassiveKmeansAgent):
-    def __init__(self, *args, bounds: ArrayLike, min_step_size: float = 0.01, **kwargs):
+    def __init__(
+        self,
+        *args,
+        bounds: ArrayLike,
+        min_step_size: float = 0.01,
+        max_candidates: int = 2**16,
+        exclusion_radius: Optional[float] = None,
+        seed: Optional[int] = None,
+        surrogate: Optional[Union[str, dict, Surrogate]] = None,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
-        self._bounds = bounds
+        self._bounds = np.asarray(bounds, dtype=float)
         self._min_step_size = min_step_size
-        self.knowledge_cache = set()  # Discretized knowledge cache of previously asked/told points
+        self.max_candidates = max_candidates  # Bound on the 2d candidates scored at once in an ask
+        # Candidates within this distance of a known point are passed over, as well as those in known cells
+        self.exclusion_radius = exclusion_radius
+        self.rng = np.random.default_rng(seed)  # Draws of 1d suggestions
+        self._surrogate = make_surrogate(surrogate, dims=self._bounds.size // 2)
+        # Discretized knowledge cache of previously asked/told points
+        self.knowledge_cache = KnowledgeCache(min_step_size, dims=self._bounds.size // 2)
+        self._asked_points = GrowableArray()  # Suggestions made, to rebuild the knowledge cache with
 
     @property
     def name(self):
@@ -93,7 +343,8 @@ class ActiveKmeansAgent(PassiveKmeansAgent):
 
     @bounds.setter
     def bounds(self, value: ArrayLike):
-        self._bounds = value
+        self._bounds = np.asarray(value, dtype=float)
+        candidate_grid.cache_clear()  # Grids of the old bounds are unlikely to be asked for again
 
     @property
     def min_step_size(self):
@@ -102,20 +353,87 @@ class ActiveKmeansAgent(PassiveKmeansAgent):
     @min_step_size.setter
     def min_step_size(self, value: ArrayLike):
         self._min_step_size = value
+        self.knowledge_cache.resolution = value
+        candidate_grid.cache_clear()
+
+    @property
+    def surrogate(self) -> str:
+        """Name of the surrogate model of the uncertainty proxy. Set by name, or with parameters as a dict,
+        such as ``{"name": "gp", "kappa": 1.0}``, which also serves the REST API."""
+        return self._surrogate.name
+
+    @surrogate.setter
+    def surrogate(self, value: Union[str, dict, Surrogate]):
+        self._surrogate = make_surrogate(value, dims=self.bounds.size // 2)
+        self._memo.pop("uncertainty_model", None)
+        self._memo.pop("acquisition_surface", None)
+
+    def candidate_grid(self) -> CandidateGrid:
+        """Full lattice of candidate points for the current bounds and step, shared between asks"""
+        return candidate_grid(tuple(np.ravel(self.bounds).tolist()), float(self.min_step_size))
 
     def server_registrations(self) -> None:
         self._register_property("bounds")
         self._register_property("min_step_size")
+        self._register_property("max_candidates")
+        self._register_property("exclusion_radius")
+        self._register_property("surrogate")
         return super().server_registrations()
 
+    def checkpoint_state(self):
+        return dict(
+            super().checkpoint_state(),
+            knowledge_cache=np.array(self.knowledge_cache.points),
+            asked_points=np.array(self._asked_points),
+        )
+
+    def restore_checkpoint_state(self, state):
+        super().restore_checkpoint_state(state)
+        self.knowledge_cache = KnowledgeCache(
+            self.min_step_size, dims=self.bounds.size // 2, points=state["knowledge_cache"]
+        )
+        self._asked_points = GrowableArray(state.get("asked_points"))
+
+    def replace_observations(self, uids, independents, observables):
+        # Only the asked points and the replaced positions are known, so runs dropped are no longer
+        self.knowledge_cache = KnowledgeCache(
+            self.min_step_size, dims=self.bounds.size // 2, points=self._asked_points.view
+        )
+        return super().replace_observations(uids, independents, observables)
+
     def tell(self, x, y):
         """A tell that adds to the local discrete knowledge cache, as well as the standard caches.
         Uses relative coords for x"""
         doc = super().tell(x - self.element_origins[0, self._element_idx], y)
-        self.knowledge_cache.add(make_hashable(discretize(doc["independent_variable"], self.min_step_size)))
+        self.knowledge_cache.add(doc["independent_variable"])
         doc["absolute_position_offset"] = self.element_origins[0, self._element_idx]
         return doc
 
+    def tell_many(self, xs, ys):
+        """A batched tell, discretizing the whole batch into the knowledge cache at once.
+        Uses relative coords for x"""
+        if len(xs) == 0:
+            return []
+        offset = self.element_origins[0, self._element_idx]
+        relative = np.asarray(xs) - offset
+        docs = super().tell_many(list(relative), ys)
+        self.knowledge_cache.add(relative)
+        for doc in docs:
+            doc["absolute_position_offset"] = offset
+        return docs
+
+    def _excluded(self, points: np.ndarray, known: Optional[np.ndarray] = None) -> np.ndarray:
+        """Which candidates lie in known cells, or within the exclusion radius of a known point"""
+        known = self.knowledge_cache.contains(points) if known is None else known
+        if self.exclusion_radius:
+            known = known | self.knowledge_cache.within(points, self.exclusion_radius)
+        return known
+
+    def exclusion_mask(self) -> np.ndarray:
+        """Mask of the points of the candidate grid that lie in cells of the knowledge cache.
+        Built once for each grid, then kept up to date as points are told and asked."""
+        return self.knowledge_cache.mask(self.candidate_grid())
+
     def _sample_uncertainty_proxy(self, batch_size=1):
         """Some Dan Olds magic to cast the distance from a cluster as an uncertainty. Then sample there
 
@@ -129,65 +447,97 @@ class ActiveKmeansAgent(PassiveKmeansAgent):
         centers : ArrayLike
             Kmeans centers for logging
         """
-        # Borrowing from Dan's jupyter fun
-        # from measurements, perform k-means
-        try:
-            sorted_independents, sorted_observables = zip(
-                *sorted(zip(self.independent_cache, self.observable_cache))
-            )
-        except ValueError:
-            # Multidimensional case
-            sorted_independents, sorted_observables = zip(
-                *sorted(zip(self.independent_cache, self.observable_cache), key=lambda x: (x[0][0], x[0][1]))
-            )
-
-        sorted_independents = np.array(sorted_independents)
-        sorted_observables = np.array(sorted_observables)
-        self.model.fit(sorted_observables)
-        # retreive centers
+        predict = self.uncertainty_model()
         centers = self.model.cluster_centers_
-        # calculate distances of all measurements from the centers
-        distances = self.model.transform(sorted_observables)
-        # determine golf-score of each point (minimum value)
-        min_landscape = distances.min(axis=1)
         if self.bounds.size == 2:
-            # Assume a 1d scan
-            # generate 'uncertainty weights' - as a polynomial fit of the golf-score for each point
-            _x = np.arange(*self.bounds, self.min_step_size)
-            uwx = polyval(_x, polyfit(sorted_independents, min_landscape, deg=5))
-            # Chose from the polynomial fit
-            return pick_from_distribution(_x, uwx, num_picks=batch_size), centers
+            # Chose from the polynomial fit, never from cells already known, nor twice in a batch
+            candidates, weights = self.acquisition_surface()
+            samples = pick_from_distribution(
+                candidates,
+                weights,
+                num_picks=batch_size,
+                replace=False,
+                exclude=self._excluded(candidates, self.exclusion_mask()),
+                rng=self.rng,
+            )
+            return samples, centers
+        elif np.prod(lattice_shape(self.bounds, self.min_step_size)) <= self.max_candidates:
+            candidates, scores = self.acquisition_surface()
+            excluded = self._excluded(candidates, self.exclusion_mask())
+            return candidates[top_k(scores, batch_size, excluded)], centers
         else:
-            # assume a 2d scan, use a linear model to predict the uncertainty
-            grid = make_wafer_grid_list(*self.bounds.ravel(), step=self.min_step_size)
-            uncertainty_preds = LinearRegression().fit(sorted_independents, min_landscape).predict(grid)
-            top_indicies = np.argsort(uncertainty_preds)[-batch_size:]
-            return grid[top_indicies], centers
+            # Search the wafer coarse to fine, so memory does not grow as the step shrinks
+            samples = wafer_top_k(
+                predict,
+                np.ravel(self.bounds),
+                self.min_step_size,
+                batch_size,
+                max_candidates=self.max_candidates,
+                exclude=self._excluded,
+            )
+            return samples, centers
 
-    def ask(self, batch_size=1):
-        suggestions, centers = self._sample_uncertainty_proxy(batch_size)
+    def uncertainty_model(self) -> Callable[[np.ndarray], np.ndarray]:
+        """Prediction of the uncertainty proxy at given positions, fit to the current data version"""
+        return self._memoized("uncertainty_model", self._fit_uncertainty_model)
+
+    def _fit_uncertainty_model(self):
+        # Borrowing from Dan's jupyter fun
+        # from measurements, perform k-means, and calculate distances of all measurements from the centers
+        # determine golf-score of each point (minimum value), kept up to date between asks
+        min_landscape = self.min_landscape()
+        # generate 'uncertainty weights' from a surrogate fit of the golf-score for each point,
+        # by default a polynomial in 1d and a linear model in 2d
+        positions = self.independent_cache.view.reshape(len(self.independent_cache), -1)
+        return self._surrogate.fit(positions, min_landscape).predict
+
+    def acquisition_surface(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Points of the candidate grid and the uncertainty predicted at each, for the current data version
+        and bounds, so that asks within a version score the grid once
+
+        Returns
+        -------
+        candidates : np.ndarray
+        weights : np.ndarray
+        """
+        return self._memoized(
+            "acquisition_surface",
+            self._compute_acquisition_surface,
+            tuple(np.ravel(self.bounds)),
+            self.min_step_size,
+        )
+
+    def _compute_acquisition_surface(self):
+        _x = self.candidate_grid().points
+        return _x, self.uncertainty_model()(_x)
+
+    def _keep_new_suggestions(self, suggestions) -> list:
+        """Suggestions not already in the knowledge cache, which are added to it and to the asked points,
+        so that the knowledge cache can be rebuilt with them when observations are replaced"""
         kept_suggestions = []
         if not isinstance(suggestions, Iterable):
             suggestions = [suggestions]
-        # Keep non redundant suggestions and add to knowledge cache
         for suggestion in suggestions:
-            hashable_suggestion = make_hashable(discretize(suggestion, self.min_step_size))
-            if hashable_suggestion in self.knowledge_cache:
+            if suggestion in self.knowledge_cache:
+                hashable_suggestion = make_hashable(discretize(np.atleast_1d(suggestion), self.min_step_size))
                 logger.info(
                     f"Suggestion {suggestion} is ignored as already in the knowledge cache: {hashable_suggestion}"
                 )
                 continue
             else:
-                self.knowledge_cache.add(hashable_suggestion)
+                self.knowledge_cache.add(suggestion)
+                self._asked_points.append(np.atleast_1d(suggestion))
                 kept_suggestions.append(suggestion)
+        return kept_suggestions
+
+    def ask(self, batch_size=1):
+        suggestions, centers = self._sample_uncertainty_proxy(batch_size)
+        # Keep non redundant suggestions and add to knowledge cache
+        kept_suggestions = self._keep_new_suggestions(suggestions)
 
         base_doc = dict(
             cluster_centers=centers,
-            cache_len=(
-                len(self.independent_cache)
-                if isinstance(self.independent_cache, list)
-                else self.independent_cache.shape[0]
-            ),
+            cache_len=len(self.independent_cache),
             latest_data=self.tell_cache[-1],
             requested_batch_size=batch_size,
             redundant_points_discarded=batch_size - len(kept_suggestions),
@@ -198,36 +548,63 @@ class ActiveKmeansAgent(PassiveKmeansAgent):
         return docs, kept_suggestions
 
 
-def current_dist_gen(x, px):
-    """from distribution defined by p(x), produce a discrete generator.
-    This helper function will normalize px as required, and return the generator ready for use.
-
-    use:
-
-    my_gen = current_dist(gen(x,px))
-
-    my_gen.rvs() = xi # random variate of given type
-
-    where xi is a random discrete value, taken from the set x, with probability px.
-
-    my_gen.rvs(size=10) = np.array([xi1, xi2, ..., xi10]) # a size=10 array from distribution.
-
-    If you want to return the probability mass function:
-
-    my_gen.pmf
-
-    See more in scipy.stats.rv_discrete
+def pick_from_distribution(
+    x: ArrayLike,
+    px: ArrayLike,
+    num_picks: int = 1,
+    *,
+    replace: bool = True,
+    exclude: Optional[np.ndarray] = None,
+    rng: Optional[np.random.Generator] = None,
+):
+    """Draw from the points x, with probability proportional to p(x).
+
+    Negative weights count as zero. Draws with replacement invert the cumulative sum with a ``searchsorted``,
+    and draws without replacement take the largest Efraimidis-Spirakis keys, ``log(u) / p(x)``,
+    so either is linear in the number of points rather than building a ``scipy.stats.rv_discrete``.
+
+    Parameters
+    ----------
+    x : ArrayLike
+        Points to draw from
+    px : ArrayLike
+        Weight of each point
+    num_picks : int
+        Number of draws. Without replacement, fewer are returned if fewer points have any weight.
+    replace : bool
+        Whether a point may be drawn more than once
+    exclude : Optional[np.ndarray]
+        Mask of points never to draw, such as those in the knowledge cache
+    rng : Optional[np.random.Generator]
+        Source of randomness, or a seed for one
+
+    Returns
+    -------
+    A single point if num_picks is 1, otherwise an array of points.
+    An empty array if every point is excluded.
     """
-    px[px < 0] = 0  # ensure non-negativitiy
-    return rv_discrete(name="my_gen", values=(x, px / sum(px)))
-
-
-def pick_from_distribution(x, px, num_picks=1):
-    my_gen = current_dist_gen(x, px)
+    x = np.asarray(x)
+    weights = np.clip(np.asarray(px, dtype=float), 0, None)
+    allowed = np.ones(len(weights), dtype=bool) if exclude is None else ~np.asarray(exclude)
+    weights[~allowed] = 0.0
+    if not allowed.any():
+        logger.warning("Every point is excluded, so there is nothing to draw")
+        return x[:0]
+    if not weights.sum() > 0:
+        logger.warning("No weight left to draw from, drawing uniformly from the allowed points instead")
+        weights = allowed.astype(float)
+    rng = np.random.default_rng(rng)
+    if replace:
+        cumulative = np.cumsum(weights)
+        picks = np.searchsorted(cumulative, rng.random(num_picks) * cumulative[-1], side="right")
+    else:
+        candidates = np.flatnonzero(weights > 0)
+        keys = np.log(rng.random(len(candidates))) / weights[candidates]
+        picks = candidates[top_k(keys, num_picks)]
     if num_picks != 1:
-        return my_gen.rvs(size=num_picks)
+        return x[picks]
     else:
-        return my_gen.rvs()
+        return x[picks[0]]
 
 
 class MultiElementActiveKmeansAgent(ActiveKmeansAgent):
@@ -254,3 +631,21 @@ class MultiElementActiveKmeansAgent(ActiveKmeansAgent):
     def tell(self, x, y):
         self.tell_count += 1
         return super().tell(x, y)
+
+    def tell_many(self, xs, ys):
+        self.tell_count += len(xs)
+        return super().tell_many(xs, ys)
+
+    def checkpoint_state(self):
+        return dict(super().checkpoint_state(), tell_count=self.tell_count)
+
+    def restore_checkpoint_state(self, state):
+        super().restore_checkpoint_state(state)
+        self.tell_count = state["tell_count"]
+
+    def replace_observations(self, uids, independents, observables):
+        # Rebuilding caches is not new data, so should not count toward the next ask
+        tell_count = self.tell_count
+        ret = super().replace_observations(uids, independents, observables)
+        self.tell_count = tell_count
+        return ret
@@ -20,12 +20,15 @@ agent = MultiElementActiveKmeansAgent(
     ask_on_tell=False,
     report_on_tell=True,
     k_clusters=6,
+    checkpoint_path="/nsls2/data/pdf/shared/config/source/bmm-agents/checkpoints/mmm3_Pt_kmeans.pkl",
     analyzed_element="Pt",
 )
 
 
 @startup_decorator
 def startup():
+    # Before start(), see BMMBaseAgent.load_checkpoint
+    agent.load_checkpoint()
     agent.start()
     path = "/nsls2/data/pdf/shared/config/source/bmm-agents/bmm_agents/startup_scripts/historical_Pt_uids.txt"
     with open(path, "r") as f:
@@ -33,7 +36,7 @@ def startup():
         for line in f:
             uids.append(line.strip().strip(",").strip("'"))
 
-    agent.tell_agent_by_uid(uids)
+    agent.bootstrap(uids)
     agent.ask_on_tell = True
     agent.add_suggestions_to_queue(1)
 
@@ -34,11 +34,14 @@ agent = KMeansMonarchSubject(
     k_clusters=6,
     queue_add_position="back",
     analyzed_element="Zr",
+    checkpoint_path="/nsls2/data/pdf/shared/config/source/bmm-agents/checkpoints/mmm3_Zr_MonarchPDFSubject.pkl",
 )
 
 
 @startup_decorator
 def startup():
+    # Before start(), see BMMBaseAgent.load_checkpoint
+    agent.load_checkpoint()
     agent.start()
     path = "/nsls2/data/pdf/shared/config/source/bmm-agents/bmm_agents/startup_scripts/historical_Zr_uids.txt"
     with open(path, "r") as f:
@@ -51,7 +54,7 @@ def startup():
         uids.append("256d67c5-6b3c-4738-8046-6838721084fc")
         uids.append("ba02aa32-de24-431e-ba42-830243fc01e6")
 
-    agent.tell_agent_by_uid(uids)
+    agent.bootstrap(uids)
     agent.add_suggestions_to_queue(1)
     agent.add_suggestions_to_subject_queue(6)
 
@@ -0,0 +1,361 @@
+"""Surrogate models of the uncertainty proxy that the active agents sample from"""
+
+import logging
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from numpy.polynomial.polynomial import polyfit, polyval
+from numpy.typing import ArrayLike
+from scipy.linalg import LinAlgError, cho_solve, cholesky, solve_triangular
+from scipy.spatial.distance import cdist
+from sklearn.linear_model import LinearRegression
+
+from .utils import AppendableKDTree, GrowableArray
+
+logger = logging.getLogger(__name__)
+
+
+class Surrogate(ABC):
+    """Model of a scalar over positions, fit to its values at the measured positions and predicting it
+    at candidates. Positions are (n, d) arrays, or (n,) in 1d.
+
+    ``fit`` is called with every measured position whenever the values change. Agents only ever add
+    positions by appending to their caches, so a surrogate may keep structure over the positions between fits.
+    """
+
+    name: str = ""
+
+    @abstractmethod
+    def fit(self, positions: ArrayLike, values: ArrayLike) -> "Surrogate":
+        """Fit to the values at each position, returning the surrogate"""
+
+    @abstractmethod
+    def predict(self, points: ArrayLike) -> np.ndarray:
+        """Predicted value at each point"""
+
+    def __call__(self, points: ArrayLike) -> np.ndarray:
+        return self.predict(points)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}()"
+
+
+class PolynomialSurrogate(Surrogate):
+    """Polynomial fit along a 1d scan
+
+    Parameters
+    ----------
+    deg : int
+        Degree of the polynomial, by default 5
+    """
+
+    name = "polynomial"
+
+    def __init__(self, deg: int = 5):
+        self.deg = deg
+        self.coefficients = None
+
+    def fit(self, positions, values):
+        self.coefficients = polyfit(
+            np.asarray(positions, dtype=float).reshape(len(values), -1)[:, 0], values, self.deg
+        )
+        return self
+
+    def predict(self, points):
+        return polyval(np.ravel(points), self.coefficients)
+
+
+class LinearSurrogate(Surrogate):
+    """Linear regression over the positions. A plane can only peak at the edge of the bounds."""
+
+    name = "linear"
+
+    def __init__(self):
+        self.model = LinearRegression()
+
+    def fit(self, positions, values):
+        positions = np.asarray(positions, dtype=float).reshape(len(values), -1)
+        self.model.fit(positions, values)
+        return self
+
+    def predict(self, points):
+        return self.model.predict(np.asarray(points, dtype=float).reshape(-1, self.model.n_features_in_))
+
+
+class NearestNeighborSurrogate(Surrogate):
+    """Inverse distance weighted mean of the values at the k nearest measured positions.
+
+    The positions are held in a KD-tree, so a batch of G candidates costs O(G log n). The tree is kept
+    between fits. Positions appended since it was built are searched by brute force, until there are
+    enough of them to be worth a rebuild. Predictions are made in chunks, bounding memory for large grids.
+
+    Parameters
+    ----------
+    k : int
+        Number of neighbours averaged, by default 8
+    power : float
+        Power of the inverse distance weights, by default 2
+    """
+
+    name = "knn"
+    _chunk_size = 8192
+
+    def __init__(self, k: int = 8, power: float = 2.0):
+        self.k = k
+        self.power = power
+        self._tree = AppendableKDTree()
+        self._positions = None
+        self._values = None
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(k={self.k}, power={self.power})"
+
+    def fit(self, positions, values):
+        values = np.asarray(values, dtype=float)
+        positions = np.asarray(positions, dtype=float).reshape(len(values), -1)
+        self._tree.update(positions)
+        self._positions, self._values = positions, values
+        return self
+
+    def predict(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, self._positions.shape[1])
+        predictions = np.empty(len(points))
+        for start in range(0, len(points), self._chunk_size):
+            chunk = slice(start, start + self._chunk_size)
+            predictions[chunk] = self._predict_chunk(points[chunk])
+        return predictions
+
+    def _predict_chunk(self, points: np.ndarray) -> np.ndarray:
+        distances, indices = self._tree.query(points, self.k)
+        with np.errstate(divide="ignore"):
+            weights = distances**-self.power
+        # A candidate on a measured position takes its value
+        exact = np.isinf(weights)
+        on_measured = exact.any(axis=1)
+        weights[on_measured] = exact[on_measured]
+        return (weights * self._values[indices]).sum(axis=1) / weights.sum(axis=1)
+
+
+class GaussianProcessSurrogate(Surrogate):
+    """Gaussian process regression with a squared exponential kernel, predicting a mean and a variance.
+
+    The kernel is ``s**2 * exp(-d**2 / (2 * length_scale**2))``, with a noise variance of ``noise * s**2``,
+    where ``s**2`` is the variance of the values at each fit. Since the scale cancels out of the mean and
+    only multiplies the variance, the Cholesky factor of the kernel matrix depends on the positions alone.
+    It is kept between fits, and extended by a block (rank-one for a single tell) update for each appended
+    position, so a fit costs O(n**2) rather than O(n**3). Predictions are made in chunks, bounding memory
+    for large grids.
+
+    Above ``max_exact`` positions, the exact GP gives way to the deterministic training conditional
+    approximation over ``n_inducing`` of the positions, chosen when the switch is made. Its cost per fit
+    is O(n * m + m**3), with m inducing points, and per candidate O(m**2).
+
+    Parameters
+    ----------
+    length_scale : float
+        Length scale of the kernel, in the units of the positions, by default 1
+    noise : float
+        Noise variance relative to the variance of the values, by default 0.01
+    kappa : float
+        Number of predicted standard deviations added to the predicted mean by ``predict``, by default 0
+    max_exact : int
+        Number of positions above which the inducing point approximation is used, by default 2000
+    n_inducing : int
+        Number of inducing points of the approximation, by default 512
+    """
+
+    name = "gp"
+    _chunk_elements = 2**22  # Kernel entries evaluated at once in a prediction
+    _jitter = 1e-8
+
+    def __init__(
+        self,
+        length_scale: float = 1.0,
+        noise: float = 1e-2,
+        kappa: float = 0.0,
+        max_exact: int = 2000,
+        n_inducing: int = 512,
+    ):
+        self.length_scale = length_scale
+        self.noise = noise
+        self.kappa = kappa
+        self.max_exact = max_exact
+        self.n_inducing = n_inducing
+        self._reset()
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(length_scale={self.length_scale}, noise={self.noise}, kappa={self.kappa}, "
+            f"max_exact={self.max_exact}, n_inducing={self.n_inducing})"
+        )
+
+    def _reset(self):
+        self._positions = None
+        self._chol = None  # Growable lower Cholesky factor of the exact kernel matrix
+        self._size = 0  # Positions factorized, or projected onto the inducing points
+        self._inducing = None
+        self._cross = None  # Kernel between each position and the inducing points
+        self._gram = None  # Sum of the outer products of the rows of the cross kernel
+        self._kmm = self._kmm_chol = self._inducing_chol = None
+        self._mean = 0.0
+        self._scale = 1.0
+        self._weights = None
+
+    def _kernel(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        return np.exp(-0.5 * cdist(a, b, "sqeuclidean") / self.length_scale**2)
+
+    @property
+    def exact(self) -> bool:
+        """Whether the last fit was the exact GP, rather than the inducing point approximation"""
+        return self._inducing is None
+
+    def fit(self, positions, values):
+        values = np.asarray(values, dtype=float)
+        positions = np.asarray(positions, dtype=float).reshape(len(values), -1)
+        appended = (
+            self._positions is not None
+            and len(positions) >= self._size
+            and positions.shape[1] == self._positions.shape[1]
+            and np.array_equal(positions[: self._size], self._positions[: self._size])
+        )
+        if not appended:
+            self._reset()
+        self._positions = positions
+        if self.exact and len(positions) > self.max_exact:
+            self._start_inducing()
+        if self.exact:
+            self._extend_cholesky()
+        else:
+            self._extend_cross()
+        self._mean = values.mean()
+        self._scale = values.std() or 1.0
+        residuals = (values - self._mean) / self._scale
+        if self.exact:
+            self._weights = cho_solve((self._chol_view, True), residuals)
+        else:
+            self._inducing_chol = cholesky(self._kmm + self._gram / self.noise, lower=True)
+            self._weights = cho_solve((self._inducing_chol, True), self._cross.view.T @ residuals) / self.noise
+        return self
+
+    @property
+    def _chol_view(self) -> np.ndarray:
+        return self._chol[: self._size, : self._size]
+
+    def _extend_cholesky(self):
+        """Extend the factor over the appended positions. With L the factor of the old block K11, the new
+        rows are [K21 L^-T, chol(K22 - K21 K11^-1 K12)]."""
+        n, new = self._size, self._positions[self._size :]
+        if not len(new):
+            return
+        end = n + len(new)
+        if self._chol is None or end > len(self._chol):
+            capacity = min(2 * (0 if self._chol is None else len(self._chol)), self.max_exact)
+            grown = np.zeros((max(capacity, end, 16),) * 2)
+            if n:
+                grown[:n, :n] = self._chol_view
+            self._chol = grown
+        k22 = self._kernel(new, new) + self.noise * np.eye(len(new))
+        if n:
+            l21 = solve_triangular(self._chol_view, self._kernel(self._positions[:n], new), lower=True).T
+            k22 -= l21 @ l21.T
+            self._chol[n:end, :n] = l21
+        try:
+            self._chol[n:end, n:end] = cholesky(k22, lower=True)
+        except LinAlgError:
+            logger.warning("Cholesky update lost positive definiteness, refactorizing")
+            k = self._kernel(self._positions, self._positions) + (self.noise + self._jitter) * np.eye(end)
+            self._chol[:end, :end] = cholesky(k, lower=True)
+        self._size = end
+
+    def _start_inducing(self):
+        """Switch to the approximation, with inducing points spread through the order the positions came in"""
+        logger.info(f"Switching to {self.n_inducing} inducing points at {len(self._positions)} positions")
+        indices = np.linspace(0, len(self._positions) - 1, min(self.n_inducing, len(self._positions)))
+        self._inducing = np.unique(self._positions[indices.astype(int)], axis=0)
+        self._kmm = self._kernel(self._inducing, self._inducing) + self._jitter * np.eye(len(self._inducing))
+        self._kmm_chol = cholesky(self._kmm, lower=True)
+        self._chol = None
+        self._cross = GrowableArray()
+        self._gram = np.zeros_like(self._kmm)
+        self._size = 0
+
+    def _extend_cross(self):
+        new = self._positions[self._size :]
+        if not len(new):
+            return
+        cross = self._kernel(new, self._inducing)
+        self._cross.extend(cross)
+        self._gram += cross.T @ cross
+        self._size = len(self._positions)
+
+    def predict(self, points):
+        if self.kappa:
+            mean, variance = self.predict_mean_variance(points)
+            return mean + self.kappa * np.sqrt(variance)
+        # The mean alone is one product per chunk, without the O(n**2) solve per point of the variance
+        points = self._rows(points)
+        mean = np.empty(len(points))
+        for chunk in self._chunks(len(points)):
+            mean[chunk] = self._cross_kernel(points[chunk]) @ self._weights
+        return self._mean + self._scale * mean
+
+    def predict_mean_variance(self, points: ArrayLike) -> Tuple[np.ndarray, np.ndarray]:
+        """Predicted mean and variance at each point"""
+        points = self._rows(points)
+        mean, variance = np.empty(len(points)), np.empty(len(points))
+        for chunk in self._chunks(len(points)):
+            mean[chunk], variance[chunk] = self._predict_chunk(points[chunk])
+        return self._mean + self._scale * mean, self._scale**2 * np.clip(variance, 0, None)
+
+    def _rows(self, points: ArrayLike) -> np.ndarray:
+        return np.asarray(points, dtype=float).reshape(-1, self._positions.shape[1])
+
+    def _chunks(self, n: int):
+        """Slices of n points whose kernel against the positions, or inducing points, fits in a chunk"""
+        chunk_size = max(1, self._chunk_elements // (self._size if self.exact else len(self._inducing)))
+        return (slice(start, start + chunk_size) for start in range(0, n, chunk_size))
+
+    def _cross_kernel(self, points: np.ndarray) -> np.ndarray:
+        return self._kernel(points, self._positions[: self._size] if self.exact else self._inducing)
+
+    def _predict_chunk(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Mean and variance at the points, in units of the scale of the values"""
+        cross = self._cross_kernel(points)
+        if self.exact:
+            v = solve_triangular(self._chol_view, cross.T, lower=True)
+            return cross @ self._weights, 1.0 - np.einsum("ij,ij->j", v, v)
+        prior = solve_triangular(self._kmm_chol, cross.T, lower=True)
+        posterior = solve_triangular(self._inducing_chol, cross.T, lower=True)
+        variance = 1.0 - np.einsum("ij,ij->j", prior, prior) + np.einsum("ij,ij->j", posterior, posterior)
+        return cross @ self._weights, variance
+
+
+surrogates = {
+    cls.name: cls
+    for cls in (PolynomialSurrogate, LinearSurrogate, NearestNeighborSurrogate, GaussianProcessSurrogate)
+}
+
+
+def make_surrogate(surrogate: Optional[Union[str, dict, Surrogate]], dims: Optional[int] = None) -> Surrogate:
+    """Surrogate by name, or as given. With no name, the polynomial in 1d and the linear model otherwise.
+
+    Parameters
+    ----------
+    surrogate : Optional[Union[str, dict, Surrogate]]
+        One of the names in ``surrogates``, a dict of a ``name`` and the keyword arguments to construct it
+        with, such as ``{"name": "gp", "kappa": 1.0}``, an instance to use, or None for the default
+    dims : Optional[int]
+        Number of dimensions of the positions, choosing the default
+    """
+    if isinstance(surrogate, Surrogate):
+        return surrogate
+    kwargs = {}
+    if isinstance(surrogate, dict):
+        kwargs = dict(surrogate)
+        surrogate = kwargs.pop("name", None)
+    if surrogate is None:
+        surrogate = "polynomial" if dims == 1 else "linear"
+    if surrogate not in surrogates:
+        raise ValueError(f"Unknown surrogate {surrogate}, expected one of {tuple(surrogates)}")
+    return surrogates[surrogate](**kwargs)
@@ -0,0 +1,54 @@
+import pytest
+from bluesky_adaptive.agents.base import Agent
+
+
+class RecordingConsumer:
+    """Stands in for the Kafka consumer of an agent that is never started"""
+
+    def set_agent(self, agent):
+        pass
+
+    def subscribe(self, callback):
+        pass
+
+
+@pytest.fixture
+def offline_agent(monkeypatch):
+    """Factory of agents with no beamline connections, that record the events they write and the asks they make.
+    Runs are read from the dict passed as ``catalog``."""
+    monkeypatch.setattr(
+        Agent, "_write_event", lambda self, stream, doc, uid=None: self.events.append((stream, doc))
+    )
+    monkeypatch.setattr(Agent, "add_suggestions_to_queue", lambda self, batch_size: self.asks.append(batch_size))
+
+    def make(cls, catalog=None, **kwargs):
+        monkeypatch.setattr(
+            cls,
+            "get_beamline_objects",
+            staticmethod(
+                lambda: dict(
+                    kafka_consumer=RecordingConsumer(),
+                    tiled_data_node={} if catalog is None else catalog,
+                    tiled_agent_node=None,
+                    qserver=None,
+                    kafka_producer=None,
+                )
+            ),
+        )
+        defaults = dict(
+            filename="test",
+            exp_mode="fluorescence",
+            read_mode="fluorescence",
+            exp_data_type="mu",
+            elements=["Pt"],
+            edges=["L3"],
+            element_origins=[[0.0, 0.0]],
+            element_det_positions=[0.0],
+            ask_on_tell=False,
+        )
+        defaults.update(kwargs)
+        agent = cls(**defaults)
+        agent.events, agent.asks = [], []
+        return agent
+
+    return make
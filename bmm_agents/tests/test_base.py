@@ -0,0 +1,157 @@
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from bluesky_adaptive.agents.base import Agent
+
+from bmm_agents.base import BMMBaseAgent
+
+
+class ListAgent(BMMBaseAgent):
+    """Agent that keeps what it is told in lists, reading each observation from the run's start document"""
+
+    name = "list"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.xs, self.ys = [], []
+
+    def tell(self, x, y):
+        if np.any(y < 0):
+            raise ValueError("Negative observation")
+        self.xs.append(x)
+        self.ys.append(y)
+        return dict(independent_variable=x, observable=y)
+
+    def ask(self, batch_size):
+        return [dict()], [0.0]
+
+    def report(self, **kwargs):
+        return dict(n_told=len(self.xs))
+
+    def trigger_condition(self, uid):
+        return True
+
+    def unpack_run(self, run):
+        return np.array([run.start["x"]]), np.array(run.start["y"], dtype=float)
+
+
+def _catalog(observations):
+    return {uid: SimpleNamespace(start=dict(uid=uid, x=x, y=y)) for uid, (x, y) in observations.items()}
+
+
+def _stop(agent, uid):
+    agent._on_stop_router("stop", dict(run_start=uid))
+
+
+def test_tells_are_batched(offline_agent):
+    "Check that runs are told in batches of at most max_tell_batch, with one report and ask per batch."
+    catalog = _catalog({f"run{i}": (float(i), [1.0, 2.0]) for i in range(5)})
+    agent = offline_agent(ListAgent, catalog, max_tell_batch=2, report_on_tell=True, ask_on_tell=True)
+    for uid in catalog:
+        _stop(agent, uid)
+    assert agent.tell_cache == ["run0", "run1", "run2", "run3"]
+    assert agent._pending_tells == ["run4"]
+    assert [stream for stream, _ in agent.events].count("report") == 2
+    assert agent.asks == [1, 1]
+    agent._work_during_wait()
+    assert agent.tell_cache == list(catalog)
+    assert [doc["exp_uid"] for stream, doc in agent.events if stream == "tell"] == list(catalog)
+    assert agent.asks == [1, 1, 1]
+
+
+def test_bad_run_in_batch(offline_agent):
+    "Check that a run failing to unpack is dropped from its batch, while the others are told."
+    catalog = _catalog({"good0": (0.0, [1.0]), "bad": (1.0, ["not a number"]), "good1": (2.0, [1.0])})
+    agent = offline_agent(ListAgent, catalog, max_tell_batch=8)
+    for uid in catalog:
+        _stop(agent, uid)
+    agent._work_during_wait()
+    assert agent.tell_cache == ["good0", "good1"]
+    assert agent._pending_tells == []
+    assert agent._failed_tells == 1
+
+
+def test_failed_batch_stays_queued(offline_agent, monkeypatch):
+    "Check that a batch the agent fails to be told is kept queued, without stopping the consumer loop."
+    catalog = _catalog({"good": (0.0, [1.0]), "negative": (1.0, [-1.0])})
+    agent = offline_agent(ListAgent, catalog, max_tell_batch=8)
+    for uid in catalog:
+        _stop(agent, uid)
+    agent._work_during_wait()
+    assert agent.tell_cache == []
+    assert agent._pending_tells == ["good", "negative"]
+    monkeypatch.setattr(Agent, "stop", lambda self, exit_status="success", reason="": None)
+    agent.stop()
+    assert agent._pending_tells == ["good", "negative"]
+
+
+def test_checkpoint_round_trip(offline_agent, tmp_path):
+    "Check that a checkpoint restores the told runs, which are then skipped, unless the signature differs."
+    catalog = _catalog({f"run{i}": (float(i), [1.0]) for i in range(3)})
+    path = tmp_path / "agent.ckpt"
+    agent = offline_agent(ListAgent, catalog, max_tell_batch=2, checkpoint_path=str(path), checkpoint_every=2)
+    agent._full_range_spectra["run0"] = (np.linspace(0, 1, 5), np.ones(5))
+    for uid in catalog:
+        _stop(agent, uid)
+    assert path.exists()
+
+    restored = offline_agent(ListAgent, catalog, checkpoint_path=str(path))
+    assert restored.load_checkpoint()
+    assert restored.tell_cache == ["run0", "run1"]
+    assert restored._pending_tells == []
+    np.testing.assert_array_equal(restored._full_range_spectra["run0"][1], np.ones(5))
+    restored.tell_agent_by_uid(catalog)
+    assert restored.tell_cache == list(catalog)
+    assert restored.xs == [np.array([2.0])]
+
+    other = offline_agent(ListAgent, catalog, checkpoint_path=str(path), read_mode="transmission")
+    assert not other.load_checkpoint()
+    assert other.tell_cache == []
+    assert not offline_agent(ListAgent, catalog, checkpoint_path=str(tmp_path / "missing")).load_checkpoint()
+
+
+def _reports(agent):
+    return [doc for stream, doc in agent.events if stream == "report"]
+
+
+def test_report_every_n_tells(offline_agent):
+    "Check that reports are held back until every_n_tells runs have been told since the last."
+    catalog = _catalog({f"run{i}": (float(i), [1.0]) for i in range(6)})
+    agent = offline_agent(
+        ListAgent, catalog, max_tell_batch=1, report_on_tell=True, report_policy=dict(every_n_tells=3)
+    )
+    for uid in list(catalog)[:5]:
+        _stop(agent, uid)
+    assert [report["n_told"] for report in _reports(agent)] == [3]
+    assert agent._pending_report is not None
+    agent._work_during_wait()
+    assert len(_reports(agent)) == 1
+    _stop(agent, "run5")
+    assert [report["n_told"] for report in _reports(agent)] == [3, 6]
+    assert agent._pending_report is None
+    with pytest.raises(ValueError):
+        agent.report_policy = dict(every_n_runs=3)
+
+
+def test_report_min_interval(offline_agent, monkeypatch):
+    "Check that a report held back by min_interval is made once the consumer is idle after the interval."
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(time, "monotonic", lambda: clock.now)
+    catalog = _catalog({f"run{i}": (float(i), [1.0]) for i in range(3)})
+    agent = offline_agent(
+        ListAgent, catalog, max_tell_batch=1, report_on_tell=True, report_policy=dict(min_interval=10.0)
+    )
+    _stop(agent, "run0")
+    clock.now += 4
+    _stop(agent, "run1")
+    clock.now += 4
+    _stop(agent, "run2")
+    agent._work_during_wait()
+    assert [report["n_told"] for report in _reports(agent)] == [1]
+    clock.now += 4
+    agent._work_during_wait()
+    assert [report["n_told"] for report in _reports(agent)] == [1, 3]
+    agent.generate_report(force=True)
+    assert len(_reports(agent)) == 3
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+
+from bmm_agents.cache import SpectrumCache
+
+
+def _arrays(n=64, seed=0):
+    rng = np.random.default_rng(seed)
+    return {name: rng.random(n) for name in SpectrumCache.fields}
+
+
+def test_put_get_round_trip(tmp_path):
+    "Check that an entry is read back with the arrays and positions it was written with"
+    cache = SpectrumCache(tmp_path)
+    arrays, positions = _arrays(), {"xafs_x": 1.5, "xafs_y": -2.0}
+    key = SpectrumCache.key("uid", "fluorescence", {}, {}, {})
+    assert cache.get(key) is None
+    cache.put(key, arrays, positions)
+    assert key in cache
+    read_arrays, read_positions = cache.get(key)
+    assert read_arrays.keys() == arrays.keys()
+    for name, value in arrays.items():
+        np.testing.assert_array_equal(read_arrays[name], value)
+    assert read_positions == positions
+    assert len(SpectrumCache(tmp_path)) == 1
+
+
+def test_key_depends_on_parameters():
+    "Check that a change in the uid, read mode, or any processing parameter changes the key"
+    base = dict(uid="uid", mode="fluorescence", pre={"pre1": -150}, bkg={"rbkg": 1.0}, fft={"kmin": 3})
+    key = SpectrumCache.key(**base)
+    assert key == SpectrumCache.key(**dict(base))
+    for name, value in [
+        ("uid", "other"),
+        ("mode", "transmission"),
+        ("pre", {"pre1": -200}),
+        ("bkg", {"rbkg": 1.1}),
+        ("fft", {"kmin": 2}),
+    ]:
+        assert SpectrumCache.key(**{**base, name: value}) != key
+    assert SpectrumCache.key(**base, fast_norm=True) != SpectrumCache.key(**base, fast_norm=False)
+
+
+def test_eviction_keeps_cache_under_max_bytes(tmp_path):
+    "Check that the least recently used entries are evicted once the cache outgrows max_bytes"
+    cache = SpectrumCache(tmp_path)
+    cache.put("first", _arrays(), {})
+    entry_size = cache.nbytes
+    cache.clear()
+
+    cache = SpectrumCache(tmp_path, max_bytes=int(2.5 * entry_size))
+    cache.put("a", _arrays(seed=1), {})
+    cache.put("b", _arrays(seed=2), {})
+    # Use "a" after "b", so that "b" is the least recently used entry
+    a_path = cache._path("a")
+    cache.get("a")
+    stat = a_path.stat()
+    os.utime(a_path, (stat.st_atime, stat.st_mtime + 10))
+    cache.put("c", _arrays(seed=3), {})
+    assert cache.nbytes <= cache.max_bytes
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
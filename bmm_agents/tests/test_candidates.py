@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from bmm_agents.candidates import candidate_grid, top_k, wafer_top_k
+from bmm_agents.utils import KnowledgeCache
+
+
+def test_top_k():
+    "Check that the highest scores come back best first, passing over those excluded."
+    scores = np.array([0.3, 0.9, 0.1, 0.7, 0.8])
+    np.testing.assert_array_equal(top_k(scores, 3), [1, 4, 3])
+    np.testing.assert_array_equal(top_k(scores, 3, exclude=scores > 0.75), [3, 0, 2])
+    assert len(top_k(scores, 10)) == 5
+    assert len(top_k(scores, 2, exclude=np.ones(5, dtype=bool))) == 0
+
+
+@pytest.mark.parametrize("k", [1, 3])
+def test_wafer_top_k_matches_full_lattice(k):
+    "Check that the coarse to fine search finds the best points of the full lattice for a smooth score."
+    bounds, step = (-1.0, 1.0, -1.0, 1.0), 0.01
+
+    def score(points):
+        # Peaked off the lattice, so that no two points tie
+        return -((points[:, 0] - 0.303) ** 2 + (points[:, 1] + 0.2014) ** 2)
+
+    grid = candidate_grid(bounds, step)
+    assert len(grid) > 1024
+    expected = grid.points[top_k(score(grid.points), k)]
+    found = wafer_top_k(score, bounds, step, k, max_candidates=1024)
+    np.testing.assert_allclose(found, expected)
+
+
+def test_wafer_top_k_excludes():
+    "Check that excluded lattice points are never returned."
+    bounds, step = (-1.0, 1.0, -1.0, 1.0), 0.01
+
+    def score(points):
+        return -np.linalg.norm(points, axis=1)
+
+    def exclude(points):
+        return np.linalg.norm(points, axis=1) < 0.05
+
+    found = wafer_top_k(score, bounds, step, 4, max_candidates=1024, exclude=exclude)
+    assert len(found) == 4
+    assert not exclude(found).any()
+
+
+def test_wafer_top_k_stays_full_under_constant_score():
+    "Check that repeated searches of a flat score keep finding full batches of new points."
+    bounds, step, k = (-1.0, 1.0, -1.0, 1.0), 0.01, 4
+    cache = KnowledgeCache(step, dims=2)
+    for _ in range(150):
+        found = wafer_top_k(lambda points: np.zeros(len(points)), bounds, step, k, 1024, exclude=cache.contains)
+        assert len(found) == k
+        assert len(cache.add(found)) == k
@@ -0,0 +1,27 @@
+import numpy as np
+
+from bmm_agents.monarch_pdf_subject import KMeansMonarchSubject
+
+
+def test_subject_asks_are_remembered(offline_agent):
+    "Check that subject suggestions are kept as asked points, so they stay known when observations are replaced."
+    agent = offline_agent(
+        KMeansMonarchSubject,
+        subject_qserver=None,
+        pdf_origin=(0.0, 0.0),
+        k_clusters=2,
+        analyzed_element="Pt",
+        bounds=(-1.0, 1.0),
+        seed=0,
+    )
+    rng = np.random.default_rng(0)
+    xs = [np.array([x]) for x in np.linspace(-0.9, 0.9, 8)]
+    ys = [np.sign(x) + rng.normal(0, 0.1, 20) for x in xs]
+    agent.tell_many(xs, ys)
+    agent.tell_cache = [f"run{i}" for i in range(len(xs))]
+    docs, suggestions = agent.subject_ask(3)
+    assert len(suggestions) > 0
+    assert len(agent._asked_points) == len(suggestions)
+    agent.replace_observations(agent.tell_cache, xs, ys)
+    for suggestion in suggestions:
+        assert suggestion in agent.knowledge_cache
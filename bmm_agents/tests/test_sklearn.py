@@ -0,0 +1,39 @@
+import numpy as np
+
+from bmm_agents.sklearn import pick_from_distribution
+
+
+def test_pick_from_distribution_follows_weights():
+    "Check that draws with replacement land on each point in proportion to its weight."
+    x = np.arange(5.0)
+    px = np.array([1.0, 0.0, 2.0, -1.0, 5.0])
+    picks = pick_from_distribution(x, px, 80_000, rng=0)
+    frequencies = np.bincount(picks.astype(int), minlength=5) / len(picks)
+    np.testing.assert_allclose(frequencies, [1 / 8, 0, 2 / 8, 0, 5 / 8], atol=0.01)
+    assert pick_from_distribution(x, px, rng=0) in x
+
+
+def test_pick_from_distribution_without_replacement():
+    "Check that draws without replacement are distinct, and never of excluded or weightless points."
+    rng = np.random.default_rng(1)
+    x = rng.uniform(size=(100, 2))
+    px = rng.uniform(size=100)
+    px[:10] = 0.0
+    exclude = np.zeros(100, dtype=bool)
+    exclude[10:20] = True
+    picks = pick_from_distribution(x, px, 50, replace=False, exclude=exclude, rng=2)
+    assert picks.shape == (50, 2)
+    assert len(np.unique(picks, axis=0)) == 50
+    drawn = (picks[:, None] == x[None]).all(axis=-1).any(axis=0)
+    assert not drawn[:20].any()
+    assert len(pick_from_distribution(x, px, 200, replace=False, exclude=exclude, rng=2)) == 80
+
+
+def test_pick_from_distribution_all_excluded():
+    "Check that nothing is drawn when every point is excluded, and weightless points are drawn uniformly."
+    x = np.arange(4.0)
+    picks = pick_from_distribution(x, np.ones(4), 3, exclude=np.ones(4, dtype=bool))
+    assert len(picks) == 0
+    exclude = np.array([True, False, True, False])
+    picks = pick_from_distribution(x, np.zeros(4), 100, exclude=exclude, rng=0)
+    assert set(picks) == {1.0, 3.0}
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from scipy.linalg import cholesky
+
+from bmm_agents.surrogates import GaussianProcessSurrogate, NearestNeighborSurrogate, make_surrogate
+
+
+def test_nearest_neighbor_surrogate_matches_brute_force():
+    "Check the inverse distance weighted mean against brute force, as positions are appended to its KD-tree."
+    rng = np.random.default_rng(3)
+    positions, values = rng.uniform(-1, 1, (400, 2)), rng.normal(size=400)
+    points = rng.uniform(-1, 1, (100, 2))
+    surrogate = NearestNeighborSurrogate(k=4)
+    for n in (200, 250, 400):
+        surrogate.fit(positions[:n], values[:n])
+        if n == 250:
+            # Appended positions within the slack are searched without rebuilding the tree
+            assert surrogate._tree._tree_size == 200
+        distances = np.linalg.norm(points[:, None] - positions[None, :n], axis=-1)
+        nearest = np.argsort(distances, axis=1)[:, :4]
+        weights = np.take_along_axis(distances, nearest, axis=1) ** -2.0
+        expected = (weights * values[nearest]).sum(axis=1) / weights.sum(axis=1)
+        np.testing.assert_allclose(surrogate(points), expected)
+    np.testing.assert_allclose(surrogate(positions[:3]), values[:3])
+
+
+def _data(n, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(-3, 3, (n, 2))
+    return positions, np.sin(positions[:, 0]) + np.cos(positions[:, 1])
+
+
+def test_gp_cholesky_update_matches_full_factorization():
+    "Check that the factor extended over appended positions is the factor of the full kernel matrix."
+    positions, values = _data(40)
+    surrogate = GaussianProcessSurrogate(length_scale=1.5)
+    for n in (1, 5, 6, 25, 40):
+        surrogate.fit(positions[:n], values[:n])
+    kernel = surrogate._kernel(positions, positions) + surrogate.noise * np.eye(len(positions))
+    np.testing.assert_allclose(surrogate._chol_view, cholesky(kernel, lower=True), atol=1e-10)
+
+    fresh = GaussianProcessSurrogate(length_scale=1.5).fit(positions, values)
+    points = np.random.default_rng(1).uniform(-3, 3, (200, 2))
+    np.testing.assert_allclose(surrogate.predict(points), fresh.predict(points), atol=1e-10)
+
+
+def test_gp_mean_without_variance():
+    "Check that predict with kappa of zero is the mean, and with kappa adds standard deviations."
+    positions, values = _data(30)
+    points = np.random.default_rng(2).uniform(-3, 3, (100, 2))
+    surrogate = GaussianProcessSurrogate().fit(positions, values)
+    surrogate._chunk_elements = 64  # Several chunks
+    mean, variance = surrogate.predict_mean_variance(points)
+    np.testing.assert_allclose(surrogate.predict(points), mean, atol=1e-12)
+    surrogate.kappa = 2.0
+    np.testing.assert_allclose(surrogate.predict(points), mean + 2.0 * np.sqrt(variance), atol=1e-12)
+    assert (variance >= 0).all()
+
+
+def test_gp_inducing_points_at_every_position_match_exact():
+    "Check that the approximation with every position as an inducing point is the exact GP."
+    # Well separated positions keep the kernel matrix, and so the jitter of the inducing points, benign
+    axis = np.linspace(-3, 3, 8)
+    positions = np.random.default_rng(3).permutation(np.stack(np.meshgrid(axis, axis), axis=-1).reshape(-1, 2))
+    values = np.sin(positions[:, 0]) + np.cos(positions[:, 1])
+    points = np.random.default_rng(4).uniform(-3, 3, (100, 2))
+    exact = GaussianProcessSurrogate(length_scale=0.5, max_exact=1000).fit(positions, values)
+    approximate = GaussianProcessSurrogate(length_scale=0.5, max_exact=30, n_inducing=1000)
+    approximate.fit(positions[:20], values[:20])
+    approximate.fit(positions, values)
+    assert exact.exact and not approximate.exact
+    for a, b in zip(approximate.predict_mean_variance(points), exact.predict_mean_variance(points)):
+        np.testing.assert_allclose(a, b, atol=1e-6)
+
+
+def test_make_surrogate():
+    "Check construction by name, with parameters, and the defaults."
+    assert make_surrogate(None, dims=1).name == "polynomial"
+    assert make_surrogate(None, dims=2).name == "linear"
+    surrogate = make_surrogate({"name": "knn", "k": 3})
+    assert isinstance(surrogate, NearestNeighborSurrogate) and surrogate.k == 3
+    surrogate = make_surrogate({"name": "gp", "kappa": 1.0})
+    assert isinstance(surrogate, GaussianProcessSurrogate) and surrogate.kappa == 1.0
+    assert make_surrogate(surrogate) is surrogate
+    with pytest.raises(ValueError):
+        make_surrogate("spline")
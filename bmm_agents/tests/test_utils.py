@@ -0,0 +1,262 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from larch import Group
+from larch.xafs import pre_edge
+
+from bmm_agents.utils import (
+    ETOK,
+    LARCH,
+    XMU_MODES,
+    AppendableKDTree,
+    GrowableArray,
+    KnowledgeCache,
+    Pandrosus,
+    _prep_worker,
+    canonical_xmu_mode,
+    exp_energy_grid,
+    exp_k_grid,
+    lattice_codes,
+    min_distances,
+    normalize_spectra,
+    resample,
+)
+
+
+def _spectrum(energy, e0, seed=0):
+    rng = np.random.default_rng(seed)
+    step = 0.5 + np.arctan((energy - e0) / 3) / np.pi
+    oscillation = 0.05 * np.sin((energy - e0).clip(0) / 15) * np.exp(-(energy - e0).clip(0) / 300)
+    background = 0.2 + 2e-4 * (energy - energy[0])
+    return background + step * (1 - 1e-4 * (energy - e0).clip(0)) + oscillation + rng.normal(0, 1e-3, energy.size)
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        dict(pre1=-150.0, pre2=-50.0, norm1=100.0, norm2=700.0, nnorm=2),
+        dict(pre1=-150.0, pre2=-50.0, norm1=50.0, norm2=300.0, nnorm=1),
+        # Regions off the ends of the data, too narrow to fit a line, or with norm1 within 2 eV of norm2
+        dict(pre1=-500.0, pre2=-199.8, norm1=798.5, norm2=900.0, nnorm=0),
+        dict(pre1=-30.0, pre2=-150.0, norm1=400.0, norm2=200.0, nnorm=1),
+    ],
+)
+def test_normalize_spectra_matches_larch(params):
+    "Check that the NumPy normalization agrees with Larch's pre_edge, given e0."
+    energy = np.arange(11364.0, 12364.0, 0.7)
+    mu = _spectrum(energy, 11564.0)
+    group = Group()
+    pre_edge(energy, mu=mu, group=group, e0=11564.3, step=None, nvict=0, _larch=LARCH, **params)
+    result = normalize_spectra(energy, mu, e0=11564.3, **params)
+    assert result["e0"] == pytest.approx(group.e0)
+    assert result["edge_step"] == pytest.approx(group.edge_step, rel=1e-6)
+    np.testing.assert_allclose(result["norm"], group.norm, atol=1e-6)
+    np.testing.assert_allclose(result["pre_edge"], group.pre_edge, atol=1e-6 * group.edge_step)
+    np.testing.assert_allclose(result["flat"], group.flat, atol=1e-6)
+    np.testing.assert_allclose(result["dmude"], group.dmude, atol=1e-6)
+
+
+def test_normalize_spectra_batches():
+    "Check that normalizing spectra together matches normalizing each alone."
+    energy = np.arange(11364.0, 12364.0, 0.7)
+    mu = np.stack([_spectrum(energy, e0, seed) for seed, e0 in enumerate((11550.0, 11564.0, 11580.0))])
+    batch = normalize_spectra(energy, mu)
+    for row, spectrum in enumerate(mu):
+        single = normalize_spectra(energy, spectrum)
+        assert batch["e0"][row] == single["e0"]
+        np.testing.assert_allclose(batch["norm"][row], single["norm"], atol=1e-9)
+    # The edge is found to within a step or two of where it was made
+    np.testing.assert_allclose(batch["e0"], [11550.0, 11564.0, 11580.0], atol=1.5)
+
+
+def test_fast_norm_stage_products():
+    "Check that the fast normalization sets everything Larch's pre_edge stage would."
+    energy = np.arange(11364.0, 12364.0, 0.7)
+    preprocessor = Pandrosus(fast_norm=True)
+    preprocessor.put(energy, _spectrum(energy, 11564.0), name="fast")
+    for attr in Pandrosus._stage_products["pre_edge"]:
+        assert getattr(preprocessor.group, attr) is not None
+    assert preprocessor.group.pre_edge_details.norm2 == preprocessor.pre["norm2"]
+
+
+def test_prep_worker_returns_details():
+    "Check that the details groups come back from a worker as plain values, with the string attributes."
+    energy = np.arange(11364.0, 12364.0, 0.7)
+    preprocessor = Pandrosus()
+    pre, attrs = _prep_worker(
+        energy, _spectrum(energy, 11564.0), preprocessor.pre, preprocessor.bkg, preprocessor.fft, "autobk"
+    )
+    assert attrs["pre_edge_details"]["norm2"] == pre["norm2"]
+    assert isinstance(attrs["autobk_details"], dict)
+    assert isinstance(attrs["edge"], str)
+    assert "chir" not in attrs
+
+
+def _make_xmu_before_xmu_modes(table, start, mode):
+    """mu(E), i0, and signal as make_xmu built them from one chain of mode checks, before XMU_MODES"""
+    if mode == "flourescence":
+        mode = "fluorescence"
+    if mode in ("reference", "ref"):
+        return np.log(table["It"] / table["Ir"]), table["It"], table["Ir"]
+    if any(md in mode for md in ("fluo", "flou", "both")) or mode == "xs":
+        columns = start["XDI"]["_dtc"]
+        signal = table[columns[0]] + table[columns[1]] + table[columns[2]] + table[columns[3]]
+        return signal / table["I0"], table["I0"], signal
+    if mode == "xs1":
+        columns = start["XDI"]["_dtc"]
+        return table[columns[0]] / table["I0"], table["I0"], table[columns[0]]
+    if mode == "yield":
+        return table["Iy"] / table["I0"], table["I0"], table["Iy"]
+    return np.log(table["I0"] / table["It"]), table["I0"], table["It"]
+
+
+@pytest.mark.parametrize(
+    "mode",
+    [
+        "transmission",
+        "reference",
+        "ref",
+        "fluorescence",
+        "flourescence",
+        "fluo",
+        "both",
+        "xs",
+        "xs1",
+        "yield",
+        "anything else",
+    ],
+)
+def test_xmu_modes_match_make_xmu(mode):
+    "Check that every read mode spelling builds the same arrays as the original make_xmu"
+    rng = np.random.default_rng(0)
+    channels = ["Pt1", "Pt2", "Pt3", "Pt4"]
+    table = {name: rng.uniform(0.5, 2.0, 50) for name in ["dcm_energy", "I0", "It", "Ir", "Iy", *channels]}
+    start = {"uid": "0" * 36, "XDI": {"_dtc": channels, "Sample": {"name": "test"}}}
+    assert canonical_xmu_mode(mode) in XMU_MODES
+
+    pandrosus = Pandrosus()
+    pandrosus.group = Group()
+    pandrosus.make_xmu(SimpleNamespace(start=start), mode, table=table)
+    for name, expected in zip(["mu", "i0", "signal"], _make_xmu_before_xmu_modes(table, start, mode)):
+        np.testing.assert_allclose(getattr(pandrosus.group, name), expected)
+    np.testing.assert_array_equal(pandrosus.group.energy, table["dcm_energy"])
+
+
+def test_growable_array():
+    "Check that rows appended past the capacity are kept, in order, in a read-only view."
+    array = GrowableArray(dtype=np.float32, capacity=2)
+    array.append([0.0, 1.0])
+    array.extend(np.arange(10, dtype=float).reshape(5, 2))
+    array.extend(np.empty((0, 2)))
+    assert len(array) == 6
+    assert array.shape == (6, 2)
+    assert array.view.dtype == np.float32
+    np.testing.assert_array_equal(array[1:], np.arange(10).reshape(5, 2))
+    assert not array.view.flags.writeable
+    with pytest.raises(ValueError):
+        array.append([0.0, 1.0, 2.0])
+    array.clear()
+    assert len(array) == 0
+
+
+def test_lattice_codes_order_cells():
+    "Check that codes are shared within a cell and order cells lexicographically."
+    points = np.array([[0.0, 0.5], [0.05, 0.55], [0.0, -0.5], [-1.0, 2.0], [0.3, -3.0]])
+    codes = lattice_codes(points, 0.1)
+    assert codes[0] == codes[1]
+    cells = np.floor(np.round(points / 0.1, 6))
+    np.testing.assert_array_equal(np.argsort(codes, kind="stable"), np.lexsort(cells.T[::-1]))
+    with pytest.raises(ValueError):
+        lattice_codes([[1e30, 0.0]], 0.1)
+
+
+def test_lattice_codes_of_no_points():
+    "Check that an empty batch of points packs into no codes."
+    assert lattice_codes(np.empty((0, 2)), 0.1).shape == (0,)
+    assert lattice_codes([], 0.1).dtype == np.int64
+
+
+def test_knowledge_cache_of_no_points():
+    "Check that a cache restored from no points can be queried, re-resolved and added to."
+    cache = KnowledgeCache(0.1, dims=1, points=np.empty((0, 1)))
+    assert len(cache) == 0
+    cache.resolution = 0.2
+    assert not cache.contains([0.5]).any()
+    assert not cache.within([0.5], 1.0).any()
+    cache.add([0.5])
+    assert 0.5 in cache
+
+
+def test_knowledge_cache_cells():
+    "Check membership by cell, the cells first made known, and re-discretizing at a new resolution."
+    cache = KnowledgeCache(0.1, dims=2)
+    new = cache.add([[0.01, 0.01], [0.02, 0.03], [0.5, 0.5]])
+    assert len(new) == 2 and len(cache) == 2
+    assert len(cache.add([[0.05, 0.05]])) == 0
+    np.testing.assert_array_equal(cache.contains([[0.09, 0.0], [0.1, 0.0], [0.55, 0.51]]), [True, False, True])
+    cache.resolution = 1.0
+    assert len(cache) == 1
+    assert [0.9, 0.9] in cache
+
+
+def test_knowledge_cache_within():
+    "Check the radius query over positions both in the KD-tree and appended since it was built."
+    rng = np.random.default_rng(0)
+    cache = KnowledgeCache(0.01, dims=2, points=rng.uniform(-1, 1, (200, 2)))
+    points = rng.uniform(-1, 1, (500, 2))
+    cache.within(points, 0.05)  # Builds the tree
+    cache.add(rng.uniform(-1, 1, (10, 2)))
+    expected = (np.linalg.norm(points[:, None] - cache.points[None], axis=-1) <= 0.05).any(axis=1)
+    np.testing.assert_array_equal(cache.within(points, 0.05), expected)
+
+
+def test_appendable_kd_tree_query():
+    "Check nearest neighbours against brute force, with and without positions appended since the build."
+    rng = np.random.default_rng(1)
+    positions = rng.uniform(0, 1, (300, 2))
+    points = rng.uniform(0, 1, (50, 2))
+    tree = AppendableKDTree(slack=64)
+    for n in (100, 130, 300):
+        distances, indices = tree.update(positions[:n]).query(points, 5)
+        brute = np.linalg.norm(points[:, None] - positions[None, :n], axis=-1)
+        np.testing.assert_allclose(np.sort(distances, axis=1), np.sort(brute, axis=1)[:, :5])
+        np.testing.assert_allclose(np.take_along_axis(brute, indices, axis=1), distances)
+
+
+def test_min_distances():
+    "Check the blocked nearest-center distances against a direct computation."
+    rng = np.random.default_rng(2)
+    points, centers = rng.normal(size=(1000, 30)), rng.normal(size=(6, 30))
+    expected = np.linalg.norm(points[:, None] - centers[None], axis=-1).min(axis=1)
+    np.testing.assert_allclose(min_distances(points, centers, block_size=128), expected, rtol=1e-10)
+    assert min_distances(points.astype(np.float32), centers).dtype == np.float32
+
+
+def test_exp_energy_grid():
+    "Check that the scan grid steps in eV below the k bounds and in k above them, ending on the last bound."
+    grid = exp_energy_grid("-200 -30 -10 25 12k", "10 2 0.3 0.05k")
+    assert grid[0] == -200.0
+    assert grid[-1] == pytest.approx(12.0**2 / ETOK)
+    assert (np.diff(grid) > 0).all()
+    np.testing.assert_allclose(np.diff(grid[grid < -30]), 10.0)
+    k = np.sqrt(grid[grid >= 25] * ETOK)
+    np.testing.assert_allclose(np.diff(k[:-1]), 0.05)
+    with pytest.raises(ValueError):
+        exp_energy_grid("-200 -30 -10", "10")
+
+
+def test_exp_k_grid():
+    "Check that the k grid runs from zero to the end of the scan at its k step, or at 0.05 without one."
+    grid = exp_k_grid("-200 -30 -10 25 12k", "10 2 0.3 0.1k")
+    assert grid[0] == 0.0
+    assert grid[-1] == pytest.approx(12.0)
+    np.testing.assert_allclose(np.diff(grid), 0.1)
+    np.testing.assert_allclose(np.diff(exp_k_grid("-200 -30 500", "10 1")), 0.05)
+
+
+def test_resample():
+    "Check that resampling interpolates linearly, holding the end values beyond the measured range."
+    x = np.array([0.0, 1.0, 3.0])
+    y = 2 * x + 1
+    np.testing.assert_allclose(resample(x, y, [-1.0, 0.5, 2.0, 5.0]), [1.0, 2.0, 5.0, 7.0])
@@ -1,15 +1,26 @@
 # Borrowed from https://github.com/NSLS-II-BMM/profile_collection/blob/master/startup/BMM/larch_interface.py
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
 import larch.utils.show as lus
 import numpy
 import numpy as np
 from larch import Group, Interpreter
 from larch.xafs import autobk, find_e0, pre_edge, xftf
+from larch.xray import guess_edge
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
 
 LARCH = Interpreter()
 
+logger = logging.getLogger(__name__)
+
 
 def discretize(value: np.typing.ArrayLike, resolution: np.typing.ArrayLike):
-    return np.floor(value / resolution)
+    # Round off float error first, so that a point on the lattice is never floored into the cell below
+    return np.floor(np.round(np.asarray(value) / resolution, 6))
 
 
 def make_hashable(x):
@@ -19,6 +30,314 @@ def make_hashable(x):
         return float(x)
 
 
+class GrowableArray:
+    """Rows of a common shape held in a preallocated ndarray that doubles in capacity as it fills.
+    Appending is amortized O(1), and the filled region is available as a read-only view without a copy.
+
+    Parameters
+    ----------
+    rows : Optional[ArrayLike]
+        Initial rows
+    dtype : np.typing.DTypeLike
+        Type rows are stored as, by default float64. float32 halves the memory of a large cache.
+    capacity : int
+        Number of rows allocated for on the first append
+    """
+
+    def __init__(self, rows=None, dtype=np.float64, capacity: int = 16):
+        self.dtype = np.dtype(dtype)
+        self._initial_capacity = capacity
+        self._data = None
+        self._size = 0
+        if rows is not None:
+            self.extend(rows)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def view(self) -> np.ndarray:
+        """Filled rows, without a copy"""
+        if self._data is None:
+            return np.empty((0,), dtype=self.dtype)
+        view = self._data[: self._size]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.view.shape
+
+    @property
+    def nbytes(self) -> int:
+        """Memory allocated, including unfilled capacity"""
+        return 0 if self._data is None else self._data.nbytes
+
+    def _reserve(self, n: int, row_shape: Tuple[int, ...]):
+        if self._data is None:
+            self._data = np.empty((max(self._initial_capacity, n), *row_shape), dtype=self.dtype)
+            return
+        if row_shape != self._data.shape[1:]:
+            raise ValueError(f"Cannot add rows of shape {row_shape} to rows of shape {self._data.shape[1:]}")
+        if self._size + n > self._data.shape[0]:
+            data = np.empty((max(2 * self._data.shape[0], self._size + n), *row_shape), dtype=self.dtype)
+            data[: self._size] = self._data[: self._size]
+            self._data = data
+
+    def append(self, row):
+        row = np.asarray(row, dtype=self.dtype)
+        self._reserve(1, row.shape)
+        self._data[self._size] = row
+        self._size += 1
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self.dtype)
+        if rows.shape[0] == 0:
+            return
+        self._reserve(rows.shape[0], rows.shape[1:])
+        self._data[self._size : self._size + rows.shape[0]] = rows
+        self._size += rows.shape[0]
+
+    def clear(self):
+        self._size = 0
+
+    def __array__(self, dtype=None, copy=None):
+        view = self.view
+        if copy or (dtype is not None and np.dtype(dtype) != self.dtype):
+            return np.array(view, dtype=dtype)
+        return view
+
+    def __getitem__(self, index):
+        return self.view[index]
+
+    def __iter__(self):
+        return iter(self.view)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.view!r})"
+
+
+def min_distances(points: np.ndarray, centers: np.ndarray, block_size: int = 4096) -> np.ndarray:
+    """Euclidean distance from each point to its nearest center, in the type of the points.
+
+    Points are taken in blocks, each expanded as ``|x|**2 - 2 x.c + |c|**2`` so that the work is one matrix
+    product against the centers, and memory is bounded by ``block_size`` rows of distances.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        Points of shape (n, d)
+    centers : np.ndarray
+        Centers of shape (k, d)
+    block_size : int
+        Number of points taken at once
+    """
+    points = np.asarray(points)
+    dtype = points.dtype if np.issubdtype(points.dtype, np.floating) else np.dtype(float)
+    centers = np.asarray(centers, dtype=dtype)
+    center_norms = np.einsum("ij,ij->i", centers, centers)
+    nearest = np.empty(len(points), dtype=dtype)
+    for start in range(0, len(points), block_size):
+        block = np.asarray(points[start : start + block_size], dtype=dtype)
+        squared = (center_norms - 2 * (block @ centers.T)).min(axis=1) + np.einsum("ij,ij->i", block, block)
+        nearest[start : start + block_size] = np.sqrt(np.clip(squared, 0, None))
+    return nearest
+
+
+def lattice_codes(points: np.typing.ArrayLike, resolution: float) -> np.ndarray:
+    """Pack points, discretized at ``resolution``, into int64 codes that order the points lexicographically
+    by their lattice coordinates. Each of d dimensions gets 63 // d bits.
+
+    Parameters
+    ----------
+    points : ArrayLike
+        Points of shape (n, d), or (n,) for one dimension
+    resolution : float
+        Lattice spacing
+    """
+    points = np.asarray(points, dtype=float)
+    if len(points) == 0:
+        return np.empty(0, dtype=np.int64)
+    cells = discretize(points.reshape(len(points), -1), resolution)
+    bits = 63 // cells.shape[1]
+    offset = 1 << (bits - 1)
+    if cells.size and (cells.min() < -offset or cells.max() >= offset):
+        raise ValueError(f"Points span more than the {bits} bit lattice allows at a resolution of {resolution}")
+    codes = np.zeros(len(cells), dtype=np.int64)
+    for column in cells.T.astype(np.int64):
+        codes = (codes << bits) | (column + offset)
+    return codes
+
+
+class AppendableKDTree:
+    """KD-tree over positions that only grow by appending. Positions appended since the tree was built are
+    searched by brute force, until there are more than ``slack`` of them and the tree is rebuilt.
+
+    Parameters
+    ----------
+    slack : int
+        Number of appended positions searched by brute force before a rebuild, by default 64
+    """
+
+    def __init__(self, slack: int = 64):
+        self.slack = slack
+        self._tree = None
+        self._points = np.empty((0, 1))
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    @property
+    def _tree_size(self) -> int:
+        return 0 if self._tree is None else self._tree.n
+
+    def update(self, points: np.ndarray) -> "AppendableKDTree":
+        """Take every position, as (n, d). The tree is kept if they extend those last given."""
+        points = np.asarray(points, dtype=float)
+        n = self._tree_size
+        appended = (
+            n > 0
+            and len(points) >= n
+            and points.shape[1] == self._tree.m
+            and np.array_equal(points[n - 1], self._tree.data[n - 1])
+        )
+        if not appended or len(points) - n > self.slack:
+            self._tree = cKDTree(points) if len(points) else None
+        self._points = points
+        return self
+
+    def query(self, points: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Distances to and indices of the k nearest positions to each point, as (n, k) arrays in no order"""
+        k = min(k, len(self._points))
+        n = self._tree_size
+        if n:
+            distances, indices = self._tree.query(points, k=min(k, n))
+            distances, indices = distances.reshape(len(points), -1), indices.reshape(len(points), -1)
+        else:
+            distances, indices = np.empty((len(points), 0)), np.empty((len(points), 0), dtype=np.int64)
+        recent = self._points[n:]
+        if len(recent):
+            recent_distances = cdist(points, recent)
+            recent_indices = np.broadcast_to(np.arange(n, len(self._points)), recent_distances.shape)
+            distances = np.hstack([distances, recent_distances])
+            indices = np.hstack([indices, recent_indices])
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            distances = np.take_along_axis(distances, nearest, axis=1)
+            indices = np.take_along_axis(indices, nearest, axis=1)
+        return distances, indices
+
+    def any_within(self, points: np.ndarray, radius: float) -> np.ndarray:
+        """Whether any position lies within ``radius`` of each point"""
+        near = np.zeros(len(points), dtype=bool)
+        n = self._tree_size
+        if n:
+            near |= np.isfinite(self._tree.query(points, distance_upper_bound=np.nextafter(radius, np.inf))[0])
+        recent = self._points[n:]
+        if len(recent):
+            near |= (cdist(points, recent) <= radius).any(axis=1)
+        return near
+
+
+class KnowledgeCache:
+    """Cells of a lattice that have already been measured or asked for, held as sorted ``lattice_codes``,
+    so that checking or adding a whole batch of points is a ``searchsorted`` rather than a hash per point.
+
+    The raw positions are kept too. They answer whether any known position lies within a radius of a point,
+    through a KD-tree, and are re-discretized when the resolution changes.
+
+    Parameters
+    ----------
+    resolution : float
+        Lattice spacing of the cells
+    dims : int
+        Number of dimensions of a position, by default 1
+    points : Optional[ArrayLike]
+        Initial positions, as (n, dims), or (n,) in one dimension
+    """
+
+    def __init__(self, resolution: float, dims: int = 1, points: Optional[np.typing.ArrayLike] = None):
+        self._resolution = float(resolution)
+        self.dims = dims
+        self._points = GrowableArray()
+        self._codes = np.empty(0, dtype=np.int64)
+        self._tree = AppendableKDTree()
+        self._grid_mask = None  # Candidate grid, with a mask of its points in known cells
+        if points is not None:
+            self.add(points)
+
+    def __len__(self) -> int:
+        """Number of known cells"""
+        return len(self._codes)
+
+    def __contains__(self, point) -> bool:
+        return bool(self.contains(point)[0])
+
+    @property
+    def resolution(self) -> float:
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, value: float):
+        self._resolution = float(value)
+        self._codes = np.unique(lattice_codes(self.points, self._resolution))
+        self._grid_mask = None
+
+    @property
+    def codes(self) -> np.ndarray:
+        """Sorted codes of the known cells"""
+        codes = self._codes.view()
+        codes.flags.writeable = False
+        return codes
+
+    @property
+    def points(self) -> np.ndarray:
+        """Every position added, in order"""
+        return self._points.view.reshape(-1, self.dims)
+
+    def _rows(self, points: np.typing.ArrayLike) -> np.ndarray:
+        return np.asarray(points, dtype=float).reshape(-1, self.dims)
+
+    def _contains_codes(self, codes: np.ndarray) -> np.ndarray:
+        if len(self._codes) == 0:
+            return np.zeros(len(codes), dtype=bool)
+        return self._codes[np.minimum(np.searchsorted(self._codes, codes), len(self._codes) - 1)] == codes
+
+    def contains(self, points: np.typing.ArrayLike) -> np.ndarray:
+        """Whether each point lies in a known cell"""
+        return self._contains_codes(lattice_codes(self._rows(points), self._resolution))
+
+    def add(self, points: np.typing.ArrayLike) -> np.ndarray:
+        """Add positions, returning the codes of the cells they made known for the first time"""
+        rows = self._rows(points)
+        self._points.extend(rows)
+        codes = np.unique(lattice_codes(rows, self._resolution))
+        codes = codes[~self._contains_codes(codes)]
+        self._codes = np.insert(self._codes, np.searchsorted(self._codes, codes), codes)
+        if self._grid_mask is not None:
+            grid, mask = self._grid_mask
+            mask[grid.cell_matches(codes)] = True
+        return codes
+
+    def within(self, points: np.typing.ArrayLike, radius: float) -> np.ndarray:
+        """Whether any known position lies within ``radius`` of each point"""
+        return self._tree.update(self.points).any_within(self._rows(points), radius)
+
+    def mask(self, grid) -> np.ndarray:
+        """Mask of the points of a ``bmm_agents.candidates.CandidateGrid``, at the same resolution,
+        that lie in known cells. Built once for each grid, then kept up to date as positions are added."""
+        if self._grid_mask is None or self._grid_mask[0] is not grid:
+            self._grid_mask = (grid, np.isin(grid.cell_codes, self._codes))
+        mask = self._grid_mask[1].view()
+        mask.flags.writeable = False
+        return mask
+
+    def clear(self):
+        self._points.clear()
+        self._codes = np.empty(0, dtype=np.int64)
+        self._tree = AppendableKDTree()
+        self._grid_mask = None
+
+
 def make_wafer_grid_list(x_min, x_max, y_min, y_max, step):
     """
     Make the list of all of the possible 2d points that lie within a circle of the origin
@@ -32,6 +351,299 @@ def make_wafer_grid_list(x_min, x_max, y_min, y_max, step):
     return np.array([xx[distance < radius], yy[distance < radius]]).T
 
 
+ETOK = 0.2624682917  # Converts energy above the edge in eV to k**2 in inverse square angstroms
+
+
+def parse_exp_grid(exp_bounds: str, exp_steps: str) -> Tuple[List[float], List[Tuple[float, bool]]]:
+    """Parse the bounds and steps strings of a BMM XAFS scan.
+
+    Bounds are relative to e0, in eV or in k with a trailing "k". Steps are likewise
+    in eV or in k, one fewer than the bounds.
+
+    Returns
+    -------
+    bounds : List[float]
+        Bounds in eV relative to e0
+    steps : List[Tuple[float, bool]]
+        Each step, with whether it is in k
+    """
+    bounds = [float(b[:-1]) ** 2 / ETOK if b.endswith("k") else float(b) for b in exp_bounds.split()]
+    steps = [(float(s[:-1]), True) if s.endswith("k") else (float(s), False) for s in exp_steps.split()]
+    if len(steps) != len(bounds) - 1:
+        raise ValueError(f"Expected {len(bounds) - 1} steps for bounds {exp_bounds!r}, received {exp_steps!r}")
+    return bounds, steps
+
+
+def exp_energy_grid(exp_bounds: str, exp_steps: str) -> np.ndarray:
+    """Energy grid, relative to e0, of a BMM XAFS scan"""
+    bounds, steps = parse_exp_grid(exp_bounds, exp_steps)
+    regions = []
+    for start, stop, (step, in_k) in zip(bounds[:-1], bounds[1:], steps):
+        if in_k:
+            k = np.arange(np.sqrt(max(start, 0) * ETOK), np.sqrt(stop * ETOK), step)
+            regions.append(k**2 / ETOK)
+        else:
+            regions.append(np.arange(start, stop, step))
+    regions.append([bounds[-1]])
+    return np.concatenate(regions)
+
+
+def exp_k_grid(exp_bounds: str, exp_steps: str) -> np.ndarray:
+    """Uniform k grid from zero to the end of a BMM XAFS scan, at the scan's k step if it has one"""
+    bounds, steps = parse_exp_grid(exp_bounds, exp_steps)
+    k_steps = [step for step, in_k in steps if in_k]
+    step = k_steps[-1] if k_steps else 0.05
+    kmax = np.sqrt(max(bounds[-1], 0) * ETOK)
+    return np.arange(0, kmax + step / 2, step)
+
+
+def resample(x: np.ndarray, y: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    """Linearly interpolate y(x) onto grid. Points beyond the measured range take the nearest end value."""
+    return np.interp(grid, x, y)
+
+
+def find_edge_energies(energy: np.ndarray, mu: np.ndarray) -> np.ndarray:
+    """Edge energy of each spectrum as the maximum of the derivative of mu(E).
+
+    Parameters
+    ----------
+    energy : np.ndarray
+        Energy grid of shape (N,), shared by all spectra
+    mu : np.ndarray
+        Spectra of shape (N,) or (M, N)
+
+    Returns
+    -------
+    e0 : np.ndarray
+        Edge energies, of shape () or (M,)
+    """
+    dmude = np.gradient(mu, energy, axis=-1)
+    # Ignore the end points, where the derivative is often noise
+    return energy[2:-2][np.argmax(dmude[..., 2:-2], axis=-1)]
+
+
+def _batched_polyfit(x: np.ndarray, y: np.ndarray, mask: np.ndarray, deg: int) -> np.ndarray:
+    """Least squares polynomial fit of each row of y against x, using the points selected by each row of mask.
+    Returns coefficients of shape (M, deg + 1) in increasing order."""
+    design = np.vander(x, deg + 1, increasing=True)
+    weights = mask.astype(float)
+    lhs = np.einsum("mn,ni,nj->mij", weights, design, design)
+    rhs = np.einsum("mn,ni->mi", weights * y, design)
+    return (np.linalg.pinv(lhs) @ rhs[..., None])[..., 0]
+
+
+def normalize_spectra(
+    energy: np.ndarray,
+    mu: np.ndarray,
+    e0: Optional[float] = None,
+    pre1: Optional[float] = None,
+    pre2: Optional[float] = None,
+    norm1: Optional[float] = None,
+    norm2: Optional[float] = None,
+    nnorm: Optional[int] = None,
+    nvict: int = 0,
+) -> Dict[str, np.ndarray]:
+    """Pure NumPy edge-step normalization of many spectra on a shared energy grid.
+
+    Follows Larch's ``pre_edge`` -- a line fit to mu*E**nvict over [e0+pre1, e0+pre2], a polynomial of
+    degree nnorm fit to the pre-edge subtracted data over [e0+norm1, e0+norm2], and an edge step taken
+    as the difference of the two at e0 -- with all spectra fit together as batched least squares.
+    As in Larch, the regions are clipped to the data, norm1 is kept at least 2 eV below norm2, a pre-edge
+    region under three points wide is fit by a constant, and a narrow post-edge region by a lower degree.
+    Parameters left as None take the same defaults as ``Pandrosus.prep``, relative to each spectrum's e0.
+
+    E0 comes from the maximum of the derivative rather than Larch's smoothed ``find_e0``, so it may
+    differ by about one energy step on noisy data. With e0 given, ``norm`` agrees with Larch to within
+    1e-6 of the edge step, as ``bmm_agents/tests/test_utils.py`` checks.
+
+    Parameters
+    ----------
+    energy : np.ndarray
+        Energy grid of shape (N,)
+    mu : np.ndarray
+        Spectra of shape (N,) or (M, N)
+
+    Returns
+    -------
+    result : Dict[str, np.ndarray]
+        e0, edge_step, norm, flat, dmude, pre_edge and post_edge, with a leading batch axis when mu is 2D
+    """
+    energy = np.asarray(energy, dtype=float)
+    mu = np.asarray(mu, dtype=float)
+    squeeze = mu.ndim == 1
+    mu = np.atleast_2d(mu)
+    n_spectra = mu.shape[0]
+    if e0 is None:
+        e0 = find_edge_energies(energy, mu)
+    else:
+        # Larch finds e0 itself when the one given is off the grid
+        e0 = np.broadcast_to(np.asarray(e0, dtype=float), (n_spectra,))
+        off_grid = (e0 < energy[1]) | (e0 > energy[-2])
+        if off_grid.any():
+            e0 = np.where(off_grid, find_edge_energies(energy, mu), e0)
+    ie0 = np.abs(energy - e0[:, None]).argmin(axis=-1)
+    e0 = e0[:, None]
+
+    norm2 = energy.max() - e0 if norm2 is None else np.full_like(e0, norm2)
+    norm1 = norm2 / 5 if norm1 is None else np.full_like(e0, norm1)
+    pre1 = energy.min() - e0 if pre1 is None else np.full_like(e0, pre1)
+    pre2 = pre1 / 3 if pre2 is None else np.full_like(e0, pre2)
+
+    # Clip and order the regions as Larch does
+    pre1 = np.maximum(pre1, energy.min() - e0)
+    pre1, pre2 = np.minimum(pre1, pre2), np.maximum(pre1, pre2)
+    norm2 = np.where(norm2 < 0, energy.max() - e0 - norm2, norm2)
+    norm2 = np.minimum(norm2, energy.max() - e0)
+    norm1, norm2 = np.minimum(norm1, norm2), np.maximum(norm1, norm2)
+    norm1 = np.minimum(norm1, norm2 - 2)
+
+    # Same index conventions as Larch: regions start at the point at or below the lower bound, and stop
+    # before the point nearest the upper bound
+    def index_of(value):
+        return np.maximum(np.searchsorted(energy, value, side="right") - 1, 0)
+
+    def index_nearest(value):
+        return np.abs(energy - value).argmin(axis=-1)[:, None]
+
+    index = np.arange(energy.size)
+
+    # Fit in a centered, scaled coordinate for conditioning; the fitted curves are the same
+    scale = (energy.max() - energy.min()) / 2
+    x = (energy - energy.min()) / scale - 1
+    victoreen = energy**nvict
+
+    # The pre-edge is a line, or the mean of mu where its region is under three points wide
+    start, stop = index_of(pre1 + e0), index_nearest(pre2 + e0)
+    line = index_of(pre2 + e0) - start >= 3
+    stop = np.where(
+        line, np.where(stop - start < 2, np.minimum(energy.size, start + 2), stop), np.maximum(stop, start + 1)
+    )
+    pre_region = (index >= start) & (index < stop)
+    pre_coefs = _batched_polyfit(x, mu * victoreen, pre_region, 1)
+    pre_mean = _batched_polyfit(x, mu, pre_region, 0)
+    pre_edge = np.where(line, (pre_coefs[:, :1] + pre_coefs[:, 1:2] * x) / victoreen, pre_mean)
+
+    # The post-edge fit drops in degree as its region narrows
+    if nnorm is None:
+        span = (norm2 - norm1)[:, 0]
+        degrees = np.where(span < 30, 0, np.where(span < 300, 1, 2))
+    else:
+        degrees = np.full(n_spectra, nnorm)
+    start, stop = np.minimum(index_of(norm1 + e0), energy.size - 3), index_nearest(norm2 + e0)
+    narrow = (stop - start < 2)[:, 0]
+    degrees = np.where(narrow, 0, np.where((stop - start < 5)[:, 0], np.minimum(degrees, 1), degrees))
+    start = np.where(narrow[:, None], np.maximum(start - 2, 0), start)
+    norm_region = (index >= start) & (index < stop)
+    post_edge = np.empty_like(mu)
+    for deg in np.unique(degrees):
+        rows = degrees == deg
+        coefs = _batched_polyfit(x, (mu - pre_edge)[rows], norm_region[rows], int(deg))
+        post_edge[rows] = pre_edge[rows] + coefs @ np.vander(x, deg + 1, increasing=True).T
+
+    rows = np.arange(n_spectra)
+    edge_step = np.maximum(np.abs(post_edge[rows, ie0] - pre_edge[rows, ie0]), 1.0e-12)
+    norm = (mu - pre_edge) / edge_step[:, None]
+    # As Larch's flat, the normalized spectrum with the curvature of the post-edge taken out above e0
+    residue = (post_edge - pre_edge) / edge_step[:, None]
+    flat = norm - (residue - residue[rows, ie0][:, None])
+    flat = np.where(np.arange(energy.size) < ie0[:, None], norm, flat)
+    result = dict(
+        e0=e0[:, 0],
+        edge_step=edge_step,
+        norm=norm,
+        flat=flat,
+        dmude=np.gradient(norm, axis=-1) / np.gradient(energy),
+        pre_edge=pre_edge,
+        post_edge=post_edge,
+    )
+    if squeeze:
+        result = {key: value[0] for key, value in result.items()}
+    return result
+
+
+class XmuMode(NamedTuple):
+    """How to build mu(E) for a read mode.
+
+    columns : Callable[[start], List[str]]
+        Detector columns needed from the primary stream, besides dcm_energy and I0, given the start document
+    reduce : Callable[[table, columns], Tuple[mu, i0, signal]]
+        Reduction of those columns, and I0, to arrays
+    """
+
+    columns: Callable
+    reduce: Callable
+
+
+def _fluorescence_channels(start):
+    #######################################################################################
+    # CAUTION!!  This only works when BMMuser is correctly set.  This is unlikely to work #
+    # on data in past history.  See new '_dtc' element of start document.  9 Sep 2020     #
+    #######################################################################################
+    return list(start["XDI"]["_dtc"])
+
+
+def _reduce_fluorescence(table, columns):
+    """Sum any number of dead-time corrected channels in one pass over a stacked buffer"""
+    i0 = numpy.asarray(table["I0"], dtype=float)
+    counts = numpy.empty((len(columns), i0.shape[0]))
+    for row, column in zip(counts, columns):
+        row[:] = table[column]
+    signal = counts.sum(axis=0)
+    return signal / i0, i0, signal
+
+
+def _reduce_ratio(numerator, denominator, log):
+    def reduce(table, columns):
+        i0 = numpy.asarray(table[numerator], dtype=float)
+        signal = numpy.asarray(table[denominator], dtype=float)
+        return (numpy.log(i0 / signal) if log else signal / i0), i0, signal
+
+    return reduce
+
+
+XMU_MODES: Dict[str, XmuMode] = {
+    "transmission": XmuMode(lambda start: ["It"], _reduce_ratio("I0", "It", log=True)),
+    "reference": XmuMode(lambda start: ["It", "Ir"], _reduce_ratio("It", "Ir", log=True)),
+    "fluorescence": XmuMode(_fluorescence_channels, _reduce_fluorescence),
+    "xs1": XmuMode(lambda start: _fluorescence_channels(start)[:1], _reduce_fluorescence),
+    "yield": XmuMode(lambda start: ["Iy"], _reduce_ratio("I0", "Iy", log=False)),
+}
+
+
+def canonical_xmu_mode(mode: str) -> str:
+    """Map the read mode spellings used at BMM onto the keys of XMU_MODES"""
+    if mode in XMU_MODES:
+        return mode
+    if mode == "ref":
+        return "reference"
+    if mode == "xs" or any(md in mode for md in ("fluo", "flou", "both")):
+        return "fluorescence"
+    return "transmission"
+
+
+class LazyGroup(Group):
+    """Larch group that can compute a missing attribute on first access.
+
+    Attribute lookups that fail are passed to a resolver, which may add the attribute to the group
+    (by running a processing stage) and return True, or return False to raise AttributeError.
+    """
+
+    def __init__(self, name=None, **kws):
+        self.__resolver = None
+        super().__init__(name=name, **kws)
+
+    def set_resolver(self, resolver):
+        """Set the resolver for missing attributes, returning the previous one"""
+        previous, self.__resolver = self.__resolver, resolver
+        return previous
+
+    def __getattr__(self, name):
+        resolver = self.__dict__.get("_LazyGroup__resolver")
+        if resolver is not None and not name.startswith("_") and resolver(name) and name in self.__dict__:
+            return self.__dict__[name]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+
 class Pandrosus:
     """A thin wrapper around basic XAS data processing for individual
     data sets as implemented in Larch.
@@ -56,6 +668,9 @@ class Pandrosus:
         Dictionary of backward Fourier transform arguments
     rmax : float
         upper bound of R-space plot
+    fast_norm : bool
+        Find e0 and normalize with ``find_edge_energies`` and ``normalize_spectra``,
+        rather than Larch's find_e0 and pre_edge
 
     See http://xraypy.github.io/xraylarch/xafs/preedge.html and
     http://xraypy.github.io/xraylarch/xafs/autobk.html for details
@@ -72,14 +687,37 @@ class Pandrosus:
     show:
         wrapper around Larch's show command, examine the content of the Larch group
     prep:
-        normalize, background subtract, and forward transform the data
+        set up normalization, background subtraction, and forward transform of the data,
+        each run lazily on first use of its results
+    run_stage:
+        run a processing stage immediately
     do_xftf:
         perform the forward (k->R) transform
     do_xftr:
         perform the reverse (R->q) transform
+    prepare_many:
+        fetch and prepare many data sets, running Larch over a process pool
     """
 
-    def __init__(self, uid=None, name=None):
+    # Processing stages in pipeline order, and the attributes each adds to the Larch group
+    _stages = ("find_e0", "pre_edge", "autobk", "xftf")
+    _stage_products = {
+        "find_e0": ("e0",),
+        "pre_edge": (
+            "edge",
+            "edge_step",
+            "norm",
+            "flat",
+            "dmude",
+            "pre_edge",
+            "post_edge",
+            "pre_edge_details",
+        ),
+        "autobk": ("k", "chi", "bkg", "chie", "ek0", "rbkg", "autobk_details"),
+        "xftf": ("r", "chir", "chir_mag", "chir_re", "chir_im", "kwin", "xftf_details"),
+    }
+
+    def __init__(self, uid=None, name=None, fast_norm=False):
         self.uid = uid
         self.name = name
         self.element = None
@@ -122,16 +760,56 @@ class Pandrosus:
         self.rmax = 6
 
         # flow control parameters
+        self.fast_norm = fast_norm
+        self._completed_stages = set()
 
-    def make_xmu(self, run, mode):
+    @classmethod
+    def stage_for(cls, attrs: Sequence[str]) -> Optional[str]:
+        """Last processing stage that has to run for the group to hold every one of ``attrs``,
+        or None if they are all available without processing"""
+        needed = [i for i, stage in enumerate(cls._stages) if set(attrs) & set(cls._stage_products[stage])]
+        return cls._stages[max(needed)] if needed else None
+
+    @staticmethod
+    def xmu_columns(start, mode):
+        """Names of the primary stream columns ``make_xmu`` needs for a given mode and start document"""
+        handler = XMU_MODES[canonical_xmu_mode(mode)]
+        return ["dcm_energy", "I0", *handler.columns(start)]
+
+    @staticmethod
+    def read_columns(run, columns, chunk_size=None):
+        """Read only the named columns of the primary stream.
+
+        Parameters
+        ----------
+        run : databroker.client.BlueskyRun
+        columns : Sequence[str]
+            Column names to request from tiled
+        chunk_size : Optional[int]
+            If given, each column is requested in slices of this many points rather than in one response.
+            With a dask-structured tiled client, columns are read lazily either way.
+        """
+        data = run.primary.data
+        if chunk_size is None:
+            return data.read(variables=list(columns))
+        table = {}
+        for column in columns:
+            node = data[column]
+            length = node.shape[0]
+            table[column] = numpy.concatenate(
+                [node.read(slice=slice(start, start + chunk_size)) for start in range(0, length, chunk_size)]
+            )
+        return table
+
+    def make_xmu(self, run, mode, chunk_size=None, table=None):
         """Load energy and mu(E) arrays into Larch and into this wrapper object.
 
         ***************************************************************
         This should be the only part of this startup script that needs
-        beamline-specific configuration.  What is shown below is
-        specific to how data are retrieved from Databroker at
-        BMM. Other beamlines -- or reading data from files -- will
-        need something different.
+        beamline-specific configuration.  What is used here, and in
+        XMU_MODES, is specific to how data are retrieved from
+        Databroker at BMM. Other beamlines -- or reading data from
+        files -- will need something different.
         ***************************************************************
 
         Parameters
@@ -139,88 +817,83 @@ class Pandrosus:
         run : databroker.client.BlueskyRun
             database identifier (assuming you are using databroker)
         mode : str
-            'transmission', 'fluorescence', or 'reference'
+            'transmission', 'fluorescence', or 'reference', or another spelling understood by
+            ``canonical_xmu_mode``
+        chunk_size : Optional[int]
+            Read columns in slices of this many points, see ``read_columns``
+        table : Optional[Mapping]
+            Columns of the primary stream that have already been read. If given, nothing is read
+            from the run, and only its start document is used.
 
         """
-        table = run.primary.data.read()
+        handler = XMU_MODES[canonical_xmu_mode(mode)]
+        columns = handler.columns(run.start)
+        if table is None:
+            table = self.read_columns(run, ["dcm_energy", "I0", *columns], chunk_size=chunk_size)
         self.group.energy = numpy.array(table["dcm_energy"])
-        self.group.i0 = numpy.array(table["I0"])
-        if mode == "flourescence":
-            mode = "fluorescence"
-        if mode == "reference":
-            self.group.mu = numpy.array(numpy.log(table["It"] / table["Ir"]))
-            self.group.i0 = numpy.array(table["It"])
-            self.group.signal = numpy.array(table["Ir"])
-
-        #######################################################################################
-        # CAUTION!!  This only works when BMMuser is correctly set.  This is unlikely to work #
-        # on data in past history.  See new '_dtc' element of start document.  9 Sep 2020     #
-        #######################################################################################
-        elif any(md in mode for md in ("fluo", "flou", "both")):
-            columns = run.start["XDI"]["_dtc"]
-            self.group.mu = numpy.array(
-                (table[columns[0]] + table[columns[1]] + table[columns[2]] + table[columns[3]]) / table["I0"]
-            )
-            self.group.i0 = numpy.array(table["I0"])
-            self.group.signal = numpy.array(
-                table[columns[0]] + table[columns[1]] + table[columns[2]] + table[columns[3]]
-            )
+        self.group.mu, self.group.i0, self.group.signal = handler.reduce(table, columns)
 
-        elif mode == "xs1":
-            columns = run.start["XDI"]["_dtc"]
-            self.group.mu = numpy.array(table[columns[0]] / table["I0"])
-            self.group.i0 = numpy.array(table["I0"])
-            self.group.signal = numpy.array(table[columns[0]])
-
-        elif mode == "xs":
-            columns = run.start["XDI"]["_dtc"]
-            self.group.mu = numpy.array(
-                (table[columns[0]] + table[columns[1]] + table[columns[2]] + table[columns[3]]) / table["I0"]
-            )
-            self.group.i0 = numpy.array(table["I0"])
-            self.group.signal = numpy.array(
-                table[columns[0]] + table[columns[1]] + table[columns[2]] + table[columns[3]]
-            )
-
-        elif mode == "ref":
-            self.group.mu = numpy.array(numpy.log(table["It"] / table["Ir"]))
-            self.group.i0 = numpy.array(table["It"])
-            self.group.signal = numpy.array(table["Ir"])
-
-        elif mode == "yield":
-            self.group.mu = numpy.array(table["Iy"] / table["I0"])
-            self.group.i0 = numpy.array(table["I0"])
-            self.group.signal = numpy.array(table["Iy"])
-
-        else:
-            self.group.mu = numpy.array(numpy.log(table["I0"] / table["It"]))
-            self.group.i0 = numpy.array(table["I0"])
-            self.group.signal = numpy.array(table["It"])
-
-    def fetch(self, run, name=None, mode="transmission"):
+    def fetch(self, run, name=None, mode="transmission", prep=True, chunk_size=None, table=None):
         self.uid = run.start["uid"]
         if name is not None:
             self.name = name
         else:
             self.name = run.start["uid"][-6:]
-        self.group = Group(__name__=self.name)
-        self.title = run.metadata["start"]["XDI"]["Sample"]["name"]
-        self.make_xmu(run, mode=mode)
-        self.prep()
+        self.group = LazyGroup(name=self.name)
+        self.title = run.start["XDI"]["Sample"]["name"]
+        self.make_xmu(run, mode=mode, chunk_size=chunk_size, table=table)
+        if prep:
+            self.prep()
 
     def put(self, energy, mu, name):
         self.name = name
-        self.group = Group(__name__=self.name)
+        self.group = LazyGroup(name=self.name)
         self.group.energy = energy
         self.group.mu = mu
         self.prep()
 
-    def prep(self):
-        if self.pre["e0"] is None:
-            find_e0(self.group.energy, mu=self.group.mu, group=self.group, _larch=LARCH)
-            ezero = self.group.e0
+    def prep(self, lazy=True):
+        """Set up the processing pipeline on the Larch group.
+
+        Each stage -- normalization, background subtraction, and the forward Fourier transform --
+        runs the first time an attribute it produces is read from ``self.group``, after any stage it
+        depends on. Pass ``lazy=False`` to run every stage immediately.
+        """
+        self._completed_stages = set()
+        self.group.set_resolver(self._resolve)
+        if not lazy:
+            self.run_stage("xftf")
+
+    def run_stage(self, stage):
+        """Run a processing stage, and any before it, unless already done"""
+        for name in self._stages[: self._stages.index(stage) + 1]:
+            if name in self._completed_stages:
+                continue
+            resolver = self.group.set_resolver(None)  # Larch probes the group while working
+            try:
+                getattr(self, f"_{name}")()
+            finally:
+                self.group.set_resolver(resolver)
+            self._completed_stages.add(name)
+
+    def _resolve(self, attr):
+        """Run the stage that produces ``attr``. Returns False if no pending stage produces it"""
+        for stage in self._stages:
+            if attr in self._stage_products[stage] and stage not in self._completed_stages:
+                self.run_stage(stage)
+                return True
+        return False
+
+    def _find_e0(self):
+        if self.pre["e0"] is not None:
+            self.group.e0 = self.pre["e0"]
+        elif self.fast_norm:
+            self.group.e0 = float(find_edge_energies(self.group.energy, self.group.mu))
         else:
-            ezero = self.pre["e0"]
+            find_e0(self.group.energy, mu=self.group.mu, group=self.group, _larch=LARCH)
+
+    def _pre_edge(self):
+        ezero = self.group.e0
         if self.pre["norm2"] is None:
             self.pre["norm2"] = self.group.energy.max() - ezero
         if self.pre["norm1"] is None:
@@ -229,6 +902,25 @@ class Pandrosus:
             self.pre["pre1"] = self.group.energy.min() - ezero
         if self.pre["pre2"] is None:
             self.pre["pre2"] = self.pre["pre1"] / 3
+        if self.fast_norm:
+            result = normalize_spectra(
+                self.group.energy,
+                self.group.mu,
+                e0=ezero,
+                pre1=self.pre["pre1"],
+                pre2=self.pre["pre2"],
+                norm1=self.pre["norm1"],
+                norm2=self.pre["norm2"],
+                nnorm=self.pre["nnorm"],
+                nvict=self.pre["nvict"],
+            )
+            for key, value in result.items():
+                setattr(self.group, key, value)
+            self.group.atsym, self.group.edge = guess_edge(self.group.e0)
+            self.group.pre_edge_details = Group(
+                **{key: self.pre[key] for key in ("pre1", "pre2", "norm1", "norm2", "nnorm", "nvict")}
+            )
+            return
         pre_edge(
             self.group.energy,
             mu=self.group.mu,
@@ -243,6 +935,8 @@ class Pandrosus:
             nvict=self.pre["nvict"],
             _larch=LARCH,
         )
+
+    def _autobk(self):
         autobk(
             self.group.energy,
             mu=self.group.mu,
@@ -254,6 +948,8 @@ class Pandrosus:
             kweight=self.bkg["kweight"],
             _larch=LARCH,
         )
+
+    def _xftf(self):
         xftf(
             self.group.k,
             chi=self.group.chi,
@@ -265,6 +961,93 @@ class Pandrosus:
             _larch=LARCH,
         )
 
+    @classmethod
+    def prepare_many(
+        cls,
+        runs: Sequence,
+        mode: str = "transmission",
+        workers: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+        tables: Optional[Sequence] = None,
+        stage: Optional[str] = "xftf",
+        fast_norm: bool = False,
+    ) -> Tuple[List[Optional["Pandrosus"]], Dict[int, Exception]]:
+        """Fetch and prepare a batch of runs, fanning the Larch pipeline out over a process pool.
+
+        Data are read from tiled in this process, unless already read and passed as ``tables``,
+        then each worker runs the pipeline through ``stage`` with its own Larch interpreter.
+        A failure in one run is logged and recorded without stopping the batch.
+
+        Parameters
+        ----------
+        runs : Sequence
+            Sequence of databroker.client.BlueskyRun
+        mode : str
+            Read mode passed to ``make_xmu``
+        workers : Optional[int]
+            Number of worker processes, by default ``os.cpu_count()``
+        chunk_size : Optional[int]
+            Passed to ``make_xmu``
+        tables : Optional[Sequence]
+            Primary stream columns already read for each run, passed to ``make_xmu``
+        stage : Optional[str]
+            Last processing stage to run, by default all of them. None only reads mu(E).
+        fast_norm : bool
+            Passed to each Pandrosus
+
+        Returns
+        -------
+        preprocessors : List[Optional[Pandrosus]]
+            Prepared objects in input order, with None in place of any run that failed
+        failures : Dict[int, Exception]
+            Exception raised for each failed run, keyed by its index in ``runs``
+        """
+        preprocessors = [None] * len(runs)
+        failures = {}
+        futures = {}
+        # Spawned workers import this module afresh, so each has its own module level Larch interpreter
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for i, run in enumerate(runs):
+                preprocessor = cls(fast_norm=fast_norm)
+                try:
+                    preprocessor.fetch(
+                        run,
+                        mode=mode,
+                        chunk_size=chunk_size,
+                        table=None if tables is None else tables[i],
+                    )
+                except Exception as e:
+                    failures[i] = e
+                    continue
+                preprocessors[i] = preprocessor
+                if stage is None:
+                    continue
+                futures[i] = pool.submit(
+                    _prep_worker,
+                    preprocessor.group.energy,
+                    preprocessor.group.mu,
+                    preprocessor.pre,
+                    preprocessor.bkg,
+                    preprocessor.fft,
+                    stage,
+                    fast_norm,
+                )
+            for i, future in futures.items():
+                try:
+                    pre, attrs = future.result()
+                except Exception as e:
+                    failures[i] = e
+                    preprocessors[i] = None
+                    continue
+                preprocessors[i].pre = pre
+                for key, value in attrs.items():
+                    setattr(preprocessors[i].group, key, Group(**value) if isinstance(value, dict) else value)
+                # Stages past the one run in the worker are left to run lazily, as after prep
+                preprocessors[i]._completed_stages.update(cls._stages[: cls._stages.index(stage) + 1])
+        for i, e in failures.items():
+            logger.warning(f"Failed to prepare run {i} of {len(runs)} in batch: {e!r}")
+        return preprocessors, failures
+
     def show(self, which=None):
         if which is None:
             lus.show(self.group, _larch=LARCH)
@@ -278,3 +1061,25 @@ class Pandrosus:
             lus.show(self.group.xftr_details, _larch=LARCH)
         else:
             lus.show(self.group, _larch=LARCH)
+
+
+def _prep_worker(energy, mu, pre, bkg, fft, stage="xftf", fast_norm=False):
+    """Run ``Pandrosus.prep`` in a worker, returning the numeric results of the Larch group.
+    The ``*_details`` groups are returned as dicts of their values, to be rebuilt as groups by the caller."""
+    preprocessor = Pandrosus(fast_norm=fast_norm)
+    preprocessor.pre, preprocessor.bkg, preprocessor.fft = pre, bkg, fft
+    preprocessor.put(energy, mu, name="worker")
+    preprocessor.run_stage(stage)
+    attrs = {}
+    for key, value in vars(preprocessor.group).items():
+        if key in ("energy", "mu") or key.startswith("_"):
+            continue
+        if isinstance(value, (numpy.ndarray, float, int, str)):
+            attrs[key] = value
+        elif key.endswith("_details") and isinstance(value, Group):
+            attrs[key] = {
+                name: detail
+                for name, detail in vars(value).items()
+                if not name.startswith("_") and isinstance(detail, (numpy.ndarray, float, int, str))
+            }
+    return preprocessor.pre, attrs